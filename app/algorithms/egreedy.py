@@ -1,18 +1,28 @@
-from typing import List
+from typing import Callable, List, Optional, Tuple
 import random
+import time
 
 import numpy as np
-from aioredis import Redis, StrictRedis
+from aioredis import StrictRedis
 import ujson
 import msgpack_numpy as m
 
+from app import keys
+from app.algorithms.forgetting import forgetting_from_meta
+from app.config.redis_router import RedisRouter
+from app.models.pymodels import RewardEvent
+from app.utils import ModelNotFoundError, transact, filter_unapplied, mark_applied, touch_model, update_model_value
+
 
 class EGreedy:
-    def __init__(self, redis: Redis):
-        self.redis = redis
+    def __init__(self, router: RedisRouter):
+        self.router = router
 
-    async def create_model(self, model_name: str, actions: List[str], epsilon: float = 0.1):
-        model_meta = await self.redis.get(f"model_meta:{model_name}")
+    async def create_model(
+        self, model_name: str, actions: List[str], epsilon: float = 0.1, forgetting: Optional[dict] = None
+    ):
+        redis = self.router.for_model(model_name)
+        model_meta = await redis.get(keys.model_meta(model_name))
         if model_meta is not None:
             raise ValueError(f"model {model_name} already exists")
         n_actions = len(actions)
@@ -21,69 +31,150 @@ class EGreedy:
             "n_actions": n_actions,
             "epsilon": epsilon,
         }
-        await self.redis.set(f"model_meta:{model_name}", ujson.dumps(model_meta))
-        await self.redis.set(f"action_successes:{model_name}", m.packb(np.zeros(n_actions)))
-        await self.redis.set(f"action_tries:{model_name}", m.packb(np.zeros(n_actions)))
-
-    async def _increment_action_tries(self, model_name: str, action: str) -> None:
-        model_meta = await self.redis.get(f"model_meta:{model_name}")
-        actions = ujson.loads(model_meta)["actions"]
-        action_tries = m.unpackb(await self.redis.get(f"action_tries:{model_name}")).copy()
-        action_tries[actions.index(action)] += 1
-        await self.redis.set(f"action_tries:{model_name}", m.packb(action_tries))
-
-    async def _epsilon_greedy_selection(self, model_name: str):
-        model_meta = await self.redis.get(f"model_meta:{model_name}")
+        if forgetting is not None:
+            model_meta["forgetting"] = forgetting
+        created_at = time.time()
+        initial = forgetting_from_meta(model_meta).initial((n_actions,), created_at)
+        async with redis.pipeline(transaction=True) as pipe:
+            pipe.set(keys.model_meta(model_name), ujson.dumps(model_meta))
+            pipe.hset(keys.model_info(model_name), mapping={
+                "algorithm": "egreedy", "created_at": created_at, "updated_at": created_at,
+            })
+            pipe.set(keys.action_successes(model_name), m.packb(initial))
+            pipe.set(keys.action_tries(model_name), m.packb(initial))
+            await pipe.execute()
+
+    async def get_model_meta(self, model_name: str) -> dict:
+        model_meta = await self.router.for_model(model_name).get(keys.model_meta(model_name))
+        if model_meta is None:
+            raise ModelNotFoundError(model_name)
+        return ujson.loads(model_meta)
+
+    async def get_actions(self, model_name: str) -> List[str]:
+        return (await self.get_model_meta(model_name))["actions"]
+
+    @staticmethod
+    def reward_error(model_meta: dict, action: str, context=None) -> Optional[str]:
+        """Why a reward cannot be applied to the model, or None if it can."""
+        if action not in model_meta["actions"]:
+            return f"action {action} not recognized"
+        return None
+
+    async def _increment_action_tries(self, model_name: str, model_meta: dict, action: str) -> None:
+        forgetting = forgetting_from_meta(model_meta)
+        action_index = model_meta["actions"].index(action)
+        await update_model_value(
+            self.router.for_model(model_name),
+            model_name,
+            keys.action_tries(model_name),
+            lambda action_tries: forgetting.add(action_tries, action_index, 1.0, time.time()),
+        )
+
+    async def _epsilon_greedy_selection(self, model_name: str) -> Tuple[str, str]:
+        """The selected action and the greedy one, which differ when exploring."""
+        redis = self.router.for_model(model_name)
+        model_meta, action_tries, action_successes = await redis.mget(
+            keys.model_meta(model_name), keys.action_tries(model_name), keys.action_successes(model_name)
+        )
         model_meta = ujson.loads(model_meta)
         actions = model_meta["actions"]
         epsilon = model_meta["epsilon"]
-        action_tries = m.unpackb(await self.redis.get(f"action_tries:{model_name}")).copy()
-        action_successes = m.unpackb(await self.redis.get(f"action_successes:{model_name}")).copy()
+        forgetting = forgetting_from_meta(model_meta)
+        now = time.time()
+        action_tries = forgetting.view(m.unpackb(action_tries), now)
+        action_successes = forgetting.view(m.unpackb(action_successes), now)
+        best_action_so_far = actions[
+            np.nanargmax(action_successes / action_tries)
+        ]
         if random.random() < epsilon:
             random_action = random.choice(actions)
-            return random_action
+            return random_action, best_action_so_far
         else:
-            best_action_so_far = actions[
-                np.nanargmax(action_successes / action_tries)
-            ]
-            return best_action_so_far
+            return best_action_so_far, best_action_so_far
 
     async def select_action(self, model_name: str) -> str:
-        model_meta = await self.redis.get(f"model_meta:{model_name}")
+        return (await self.select_action_and_best(model_name))[0]
+
+    async def select_action_and_best(
+        self, model_name: str, claim: Optional[Callable[[str], Optional[str]]] = None
+    ) -> Tuple[Optional[str], Optional[str]]:
+        """
+        The selected action and the greedy action, None while some arm is untested.
+        'claim', if given, maps the selected action to the one to record a try for,
+        or None to record nothing; see app.services.selection_guard.Decision.
+        """
+        redis = self.router.for_model(model_name)
+        model_meta, action_tries_bytes = await redis.mget(keys.model_meta(model_name), keys.action_tries(model_name))
+        if model_meta is None:
+            raise ModelNotFoundError(model_name)
         model_meta = ujson.loads(model_meta)
         actions = model_meta["actions"]
-        action_tries_byes = await self.redis.get(f"action_tries:{model_name}")
-        action_tries = m.unpackb(action_tries_byes).copy()
+        # arms whose tries all fell out of the window count as untested again
+        action_tries = forgetting_from_meta(model_meta).view(m.unpackb(action_tries_bytes), time.time())
 
         untested_actions = np.nonzero(action_tries == 0)[0]
         if untested_actions.size == 0:
-            epsilon_greedy_selection = self._epsilon_greedy_selection(
-                model_name)
-            self._increment_action_tries(model_name, epsilon_greedy_selection)
-            return epsilon_greedy_selection
+            action, best_action_so_far = await self._epsilon_greedy_selection(model_name)
         else:
-            untested_action = actions[untested_actions[0]]
-            self._increment_action_tries(model_name, untested_action)
-            return untested_action
+            action, best_action_so_far = actions[untested_actions[0]], None
+        if claim is not None:
+            action = claim(action)
+        if action is not None:
+            await self._increment_action_tries(model_name, model_meta, action)
+        return action, best_action_so_far
 
     async def reward_action(self, model_name: str, action: str) -> None:
+        redis = self.router.for_model(model_name)
+        model_meta = await self.get_model_meta(model_name)
+        error = self.reward_error(model_meta, action)
+        if error is not None:
+            raise ValueError(error)
+        action_index = model_meta["actions"].index(action)
+        forgetting = forgetting_from_meta(model_meta)
+        await update_model_value(
+            redis,
+            model_name,
+            keys.action_successes(model_name),
+            lambda action_successes: forgetting.add(action_successes, action_index, 1.0, time.time()),
+        )
+
+    async def apply_rewards(self, model_name: str, events: List[RewardEvent]) -> int:
+        """Apply a batch of reward events in one update; returns how many were new.
 
-        model_meta = await self.redis.get(f"model_meta:{model_name}")
+        Events reward_error rejects are dropped.
+        """
+        redis = self.router.for_model(model_name)
+        model_meta = await redis.get(keys.model_meta(model_name))
+        if model_meta is None:
+            raise ModelNotFoundError(model_name)
         model_meta = ujson.loads(model_meta)
         actions = model_meta["actions"]
+        forgetting = forgetting_from_meta(model_meta)
+        events = [event for event in events if self.reward_error(model_meta, event.action) is None]
+        successes_key = keys.action_successes(model_name)
 
-        action_successes = m.unpackb(await self.redis.get(f"action_successes:{model_name}")).copy()
+        async def update(pipe) -> int:
+            fresh = await filter_unapplied(redis, model_name, events)
+            action_successes = m.unpackb(await pipe.get(successes_key))
+            if fresh:
+                action_successes = forgetting.add(
+                    action_successes,
+                    [actions.index(event.action) for event in fresh],
+                    [event.reward for event in fresh],
+                    time.time(),
+                )
+            pipe.multi()
+            pipe.set(successes_key, m.packb(action_successes))
+            mark_applied(pipe, model_name, fresh)
+            touch_model(pipe, model_name)
+            return len(fresh)
 
-        if action not in actions:
-            raise ValueError(f"action {action} not recognized")
-        action_index = actions.index(action)
-        action_successes[action_index] += 1
-        await self.redis.set(f"action_successes:{model_name}", m.packb(action_successes))
+        return await transact(redis, [successes_key], update)
 
 
 async def main():
     redis = StrictRedis(host="127.0.0.1", port=6379, db=0)
-    egreedy = EGreedy(redis)
+    egreedy = EGreedy(RedisRouter.standalone(redis))
     await egreedy.create_model("test", ["a", "b", "c"])
     action = await egreedy.select_action("test")
     print(f"action: {action}")
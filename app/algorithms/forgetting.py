@@ -0,0 +1,128 @@
+"""How a model forgets old observations, so it follows drift without being recreated.
+
+A model's meta may hold a "forgetting" entry; the statistics kept per arm
+(tries, successes, covariance and reward matrices) are then stored in one of
+these forms, each bounded in size whatever the traffic:
+
+* no entry: the plain (n_actions, ...) sums, as models always were.
+* {"mode": "decay", "half_life": seconds}: exponentially decayed sums, kept
+  with forward decay. An observation at time t is added with weight
+  2 ** ((t - landmark) / half_life) and reads scale the sums by
+  2 ** (-(now - landmark) / half_life). An update costs the same as without
+  decay, nothing is rewritten periodically, and all arms of a key share one
+  landmark. When the weights get large the key is rebased onto a new
+  landmark, once every REBASE_HALF_LIVES half-lives.
+* {"mode": "window", "bucket_seconds": w, "buckets": b}: sums over the last
+  b * w seconds, kept in a ring of b time buckets per arm. Writing into a
+  bucket whose epoch has passed clears it first; reads add up the buckets
+  still inside the window.
+
+Decayed and windowed values are stored as msgpack maps of their arrays, one per
+key, so every key stays consistent on its own and can be updated atomically
+with app.utils.update_model_value.
+"""
+
+from typing import Optional, Tuple, Union
+
+import numpy as np
+
+# weights reach 2 ** 32 before a rebase, far from float64 limits
+REBASE_HALF_LIVES = 32
+
+Stored = Union[np.ndarray, dict]
+
+
+class NoForgetting:
+    enabled = False
+
+    def initial(self, shape: Tuple[int, ...], now: float) -> Stored:
+        return np.zeros(shape)
+
+    def add(self, stored: Stored, indices, values, now: float) -> Stored:
+        stored = stored.copy()
+        np.add.at(stored, indices, values)
+        return stored
+
+    def view(self, stored: Stored, now: float) -> np.ndarray:
+        return stored
+
+
+class ExponentialDecay(NoForgetting):
+    enabled = True
+
+    def __init__(self, half_life: float):
+        self.half_life = half_life
+
+    def initial(self, shape: Tuple[int, ...], now: float) -> Stored:
+        return {"landmark": now, "values": np.zeros(shape)}
+
+    def add(self, stored: Stored, indices, values, now: float) -> Stored:
+        landmark, sums = stored["landmark"], stored["values"].copy()
+        if now - landmark > REBASE_HALF_LIVES * self.half_life:
+            sums *= 2.0 ** (-(now - landmark) / self.half_life)
+            landmark = now
+        np.add.at(sums, indices, 2.0 ** ((now - landmark) / self.half_life) * np.asarray(values, dtype=np.float64))
+        return {"landmark": landmark, "values": sums}
+
+    def view(self, stored: Stored, now: float) -> np.ndarray:
+        return stored["values"] * 2.0 ** (-(now - stored["landmark"]) / self.half_life)
+
+
+class SlidingWindow(NoForgetting):
+    enabled = True
+
+    def __init__(self, bucket_seconds: float, buckets: int):
+        self.bucket_seconds = bucket_seconds
+        self.buckets = buckets
+
+    def _epoch(self, now: float) -> int:
+        return int(now // self.bucket_seconds)
+
+    def initial(self, shape: Tuple[int, ...], now: float) -> Stored:
+        return {
+            "epochs": np.full(self.buckets, -1, dtype=np.int64),
+            "values": np.zeros((shape[0], self.buckets) + tuple(shape[1:])),
+        }
+
+    def add(self, stored: Stored, indices, values, now: float) -> Stored:
+        epochs, sums = stored["epochs"].copy(), stored["values"].copy()
+        epoch = self._epoch(now)
+        slot = epoch % self.buckets
+        # a writer whose clock lags keeps adding to the newer bucket rather than clearing it
+        if epochs[slot] < epoch:
+            sums[:, slot] = 0
+            epochs[slot] = epoch
+        np.add.at(sums[:, slot], indices, values)
+        return {"epochs": epochs, "values": sums}
+
+    def view(self, stored: Stored, now: float) -> np.ndarray:
+        in_window = stored["epochs"] > self._epoch(now) - self.buckets
+        return stored["values"][:, in_window].sum(axis=1)
+
+
+def forgetting_meta(
+    decay_half_life: Optional[float] = None, window_seconds: Optional[float] = None, window_buckets: int = 10
+) -> Optional[dict]:
+    """The "forgetting" entry of a new model's meta, validated."""
+    if decay_half_life is not None and window_seconds is not None:
+        raise ValueError("choose either decay_half_life or window_seconds")
+    if decay_half_life is not None:
+        if not decay_half_life > 0:
+            raise ValueError("decay_half_life must be positive")
+        return {"mode": "decay", "half_life": decay_half_life}
+    if window_seconds is not None:
+        if not window_seconds > 0 or window_buckets < 1:
+            raise ValueError("window_seconds must be positive and window_buckets at least 1")
+        return {"mode": "window", "bucket_seconds": window_seconds / window_buckets, "buckets": window_buckets}
+    return None
+
+
+def forgetting_from_meta(model_meta: dict) -> NoForgetting:
+    forgetting = model_meta.get("forgetting")
+    if forgetting is None:
+        return NoForgetting()
+    if forgetting["mode"] == "decay":
+        return ExponentialDecay(forgetting["half_life"])
+    if forgetting["mode"] == "window":
+        return SlidingWindow(forgetting["bucket_seconds"], forgetting["buckets"])
+    raise ValueError(f"forgetting mode {forgetting['mode']} not supported")
@@ -1,107 +1,277 @@
-from typing import List
+import time
+from typing import Callable, List, Optional, Tuple
 
 import ujson
-from aioredis import Redis, StrictRedis
+from aioredis import StrictRedis
 import numpy as np
 import msgpack_numpy as m
 
+from app import keys
+from app.algorithms.forgetting import NoForgetting, forgetting_from_meta
+from app.config.redis_router import RedisRouter
+from app.models.pymodels import RewardEvent
+from app.services.shared_model_cache import SharedModelCache
+from app.utils import ModelNotFoundError, transact, filter_unapplied, mark_applied, touch_model, update_model_value
+
 
 class LinUCB:
-    def __init__(self, redis: Redis):
-        self.redis = redis
+    def __init__(self, router: RedisRouter, cache: Optional[SharedModelCache] = None):
+        self.router = router
+        self.cache = cache
 
-    async def create_model(self, model_name: str, actions: List[str], n_features: int, alpha: float = 0.1):
-        model_meta = await self.redis.get(f"model_meta:{model_name}")
+    async def create_model(
+        self, model_name: str, actions: List[str], n_features: int, alpha: float = 0.1, forgetting: Optional[dict] = None
+    ):
+        redis = self.router.for_model(model_name)
+        model_meta = await redis.get(keys.model_meta(model_name))
         if model_meta is not None:
             raise ValueError(f"model {model_name} already exists")
         n_actions = len(actions)
         model_meta = {
             "actions": actions,
             "n_actions": n_actions,
+            "n_features": n_features,
             "alpha": alpha,
         }
-        await self.redis.set(f"model_meta:{model_name}", ujson.dumps(model_meta))
-        await self.redis.set(f"action_successes:{model_name}", m.packb(np.zeros(n_actions)))
-        await self.redis.set(f"action_tries:{model_name}", m.packb(np.zeros(n_actions)))
-        await self.redis.set(f"covariance_matrices:{model_name}", m.packb(np.tile(
-            np.identity(n_features), (n_actions, 1, 1)
-        )))
-        await self.redis.set(f"reward_matrix:{model_name}", m.packb(np.zeros((n_actions, n_features))))
-
-    async def _increment_action_tries(self, model_name: str, action: str) -> None:
-        model_meta = await self.redis.get(f"model_meta:{model_name}")
-        actions = ujson.loads(model_meta)["actions"]
-        action_tries = m.unpackb(await self.redis.get(f"action_tries:{model_name}")).copy()
-        action_tries[actions.index(action)] += 1
-        await self.redis.set(f"action_tries:{model_name}", m.packb(action_tries))
-
-    async def _update_covariance_matrix(self, model_name: str, action: str, context: np.ndarray) -> None:
-        model_meta = await self.redis.get(f"model_meta:{model_name}")
-        actions = ujson.loads(model_meta)["actions"]
-        action_index = actions.index(action)
-        covariance_matrices = m.unpackb(await self.redis.get(f"covariance_matrices:{model_name}")).copy()
-        covariance_matrices[action_index] = covariance_matrices[
-            action_index
-        ] + np.dot(context, context.T)
-        await self.redis.set(f"covariance_matrices:{model_name}", m.packb(covariance_matrices))
+        if forgetting is not None:
+            model_meta["forgetting"] = forgetting
+        created_at = time.time()
+        policy = forgetting_from_meta(model_meta)
+        if policy.enabled:
+            # only observations are forgotten: the identity prior is added on read
+            covariance_matrices = policy.initial((n_actions, n_features, n_features), created_at)
+        else:
+            covariance_matrices = np.tile(np.identity(n_features), (n_actions, 1, 1))
+        async with redis.pipeline(transaction=True) as pipe:
+            pipe.set(keys.model_meta(model_name), ujson.dumps(model_meta))
+            pipe.hset(keys.model_info(model_name), mapping={
+                "algorithm": "linucb", "created_at": created_at, "updated_at": created_at,
+            })
+            pipe.set(keys.action_successes(model_name), m.packb(policy.initial((n_actions,), created_at)))
+            pipe.set(keys.action_tries(model_name), m.packb(policy.initial((n_actions,), created_at)))
+            pipe.set(keys.covariance_matrices(model_name), m.packb(covariance_matrices))
+            pipe.set(keys.reward_matrix(model_name), m.packb(policy.initial((n_actions, n_features), created_at)))
+            await pipe.execute()
 
-    async def _get_action_with_max_ucb(self, model_name: str, context: np.ndarray) -> str:
-        model_meta = await self.redis.get(f"model_meta:{model_name}")
-        alpha = ujson.loads(model_meta)["alpha"]
-        actions = ujson.loads(model_meta)["actions"]
-        covariance_matrices = m.unpackb(await self.redis.get(f"covariance_matrices:{model_name}")).copy()
-        reward_matrix = m.unpackb(await self.redis.get(f"reward_matrix:{model_name}")).copy()
-        inverse_covariance_matrices = np.linalg.inv(covariance_matrices)
-        linucb_estimates = []
-        for covariance_matrix, reward_vector in zip(
-            inverse_covariance_matrices, reward_matrix
-        ):
-            arm_coefficients = np.dot(covariance_matrix, reward_vector)
-            pointwise_estimate = np.dot(arm_coefficients, context)
-
-            upper_bound = alpha * np.sqrt(
-                np.dot(np.dot(context.T, covariance_matrix), context)
+    async def get_model_meta(self, model_name: str) -> dict:
+        model_meta = await self.router.for_model(model_name).get(keys.model_meta(model_name))
+        if model_meta is None:
+            raise ModelNotFoundError(model_name)
+        return ujson.loads(model_meta)
+
+    async def get_actions(self, model_name: str) -> List[str]:
+        return (await self.get_model_meta(model_name))["actions"]
+
+    @staticmethod
+    def reward_error(model_meta: dict, action: str, context=None) -> Optional[str]:
+        """Why a reward cannot be applied to the model, or None if it can."""
+        if action not in model_meta["actions"]:
+            return f"action {action} not recognized"
+        if context is None:
+            return "context is required"
+        # models created before n_features was kept in the meta are checked in apply_rewards
+        n_features = model_meta.get("n_features")
+        if n_features is not None and len(context) != n_features:
+            return f"context has {len(context)} features, the model expects {n_features}"
+        return None
+
+    async def _record_selection(self, model_name: str, model_meta: dict, action: str, context: np.ndarray) -> None:
+        """Count a try of 'action' and add 'context' to its covariance matrix, in one atomic update."""
+        redis = self.router.for_model(model_name)
+        forgetting = forgetting_from_meta(model_meta)
+        action_index = model_meta["actions"].index(action)
+        tries_key, covariance_key = keys.action_tries(model_name), keys.covariance_matrices(model_name)
+
+        async def update(pipe) -> None:
+            action_tries, covariance_matrices = await pipe.mget(tries_key, covariance_key)
+            now = time.time()
+            action_tries = forgetting.add(m.unpackb(action_tries), action_index, 1.0, now)
+            covariance_matrices = forgetting.add(
+                m.unpackb(covariance_matrices), action_index, np.outer(context, context), now
             )
+            pipe.multi()
+            pipe.mset({tries_key: m.packb(action_tries), covariance_key: m.packb(covariance_matrices)})
+            touch_model(pipe, model_name)
+
+        await transact(redis, [tries_key, covariance_key], update)
+
+    @staticmethod
+    def _covariance_view(forgetting: NoForgetting, covariance_matrices, now: float) -> np.ndarray:
+        covariance_matrices = forgetting.view(covariance_matrices, now)
+        if forgetting.enabled:
+            return covariance_matrices + np.identity(covariance_matrices.shape[-1])
+        return covariance_matrices
 
-            linucb_estimates.append(pointwise_estimate + upper_bound)
+    async def uncached_read_cost(self, model_name: str) -> Tuple[int, int]:
+        """Commands and bytes of the Redis reads select_action skips when the shared memory cache answers.
 
-        return actions[np.nanargmax(linucb_estimates)]
+        Those are the GET of the action tries and the MGET of load_state; the update of
+        tries and covariance after the selection is sent either way.
+        """
+        tries_key = keys.action_tries(model_name)
+        state_keys = [
+            keys.model_meta(model_name), keys.covariance_matrices(model_name), keys.reward_matrix(model_name), tries_key,
+        ]
+        async with self.router.for_model(model_name).pipeline(transaction=False) as pipe:
+            for key in [tries_key] + state_keys:
+                pipe.strlen(key)
+            sizes = await pipe.execute()
+        return 2, sum(sizes)
+
+    async def load_state(self, model_name: str) -> Tuple[dict, np.ndarray, np.ndarray, np.ndarray]:
+        """Model meta, covariance matrices, reward matrix and action tries as of now, read in one round trip."""
+        redis = self.router.for_model(model_name)
+        model_meta, covariance_matrices, reward_matrix, action_tries = await redis.mget(
+            keys.model_meta(model_name),
+            keys.covariance_matrices(model_name),
+            keys.reward_matrix(model_name),
+            keys.action_tries(model_name),
+        )
+        if model_meta is None:
+            raise ModelNotFoundError(model_name)
+        model_meta = ujson.loads(model_meta)
+        if "alpha" not in model_meta:
+            raise ValueError(f"model {model_name} is not a LinUCB model")
+        forgetting = forgetting_from_meta(model_meta)
+        now = time.time()
+        return (
+            model_meta,
+            self._covariance_view(forgetting, m.unpackb(covariance_matrices), now),
+            forgetting.view(m.unpackb(reward_matrix), now),
+            forgetting.view(m.unpackb(action_tries), now),
+        )
+
+    @staticmethod
+    def coefficients(covariance_matrices: np.ndarray, reward_matrix: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Inverse covariance matrices and per-arm coefficients, the inputs of the UCB estimates."""
+        inverse_covariance_matrices = np.linalg.inv(covariance_matrices)
+        arm_coefficients = np.einsum("kij,kj->ki", inverse_covariance_matrices, reward_matrix)
+        return inverse_covariance_matrices, arm_coefficients
+
+    @staticmethod
+    def _max_ucb_index(
+        alpha: float, inverse_covariance_matrices: np.ndarray, arm_coefficients: np.ndarray, context: np.ndarray
+    ) -> int:
+        pointwise_estimates = arm_coefficients @ context
+        upper_bounds = alpha * np.sqrt(np.einsum("i,kij,j->k", context, inverse_covariance_matrices, context))
+        return int(np.nanargmax(pointwise_estimates + upper_bounds))
+
+    async def _get_action_with_max_ucb(self, model_name: str, context: np.ndarray) -> str:
+        model_meta, covariance_matrices, reward_matrix, _ = await self.load_state(model_name)
+        inverse_covariance_matrices, arm_coefficients = self.coefficients(covariance_matrices, reward_matrix)
+        return model_meta["actions"][
+            self._max_ucb_index(model_meta["alpha"], inverse_covariance_matrices, arm_coefficients, context)
+        ]
+
+    def _get_cached_action_with_max_ucb(self, model_name: str, context: np.ndarray) -> Optional[str]:
+        """Score from the host's shared memory copy; None if it is missing or still has untested arms."""
+
+        def score(model_meta: dict, arrays: List[np.ndarray]) -> Optional[str]:
+            inverse_covariance_matrices, arm_coefficients, action_tries = arrays
+            if not action_tries.all():
+                return None
+            return model_meta["actions"][
+                self._max_ucb_index(model_meta["alpha"], inverse_covariance_matrices, arm_coefficients, context)
+            ]
+
+        return self.cache.read(model_name, score)
 
     async def select_action(self, model_name: str, context: np.ndarray) -> str:
-        model_meta = await self.redis.get(f"model_meta:{model_name}")
-        actions = ujson.loads(model_meta)["actions"]
-        action_tries = m.unpackb(await self.redis.get(f"action_tries:{model_name}")).copy()
-        untested_actions = np.nonzero(action_tries == 0)[0]
-        if untested_actions.size == 0:
-            best_action_so_far = self._get_action_with_max_ucb(context)
-            self._increment_action_tries(model_name, best_action_so_far)
-            self._update_covariance_matrix(
-                model_name, best_action_so_far, context)
-            return best_action_so_far
+        return (await self.select_action_and_best(model_name, context))[0]
+
+    async def select_action_and_best(
+        self, model_name: str, context: np.ndarray, claim: Optional[Callable[[str], Optional[str]]] = None
+    ) -> Tuple[Optional[str], Optional[str]]:
+        """
+        The selected action and the arm with the highest UCB estimate, None while some arm is untested.
+        'claim', if given, maps the selected action to the one to record the selection of,
+        or None to record nothing; see app.services.selection_guard.Decision.
+        """
+        redis = self.router.for_model(model_name)
+        context = np.asarray(context, dtype=np.float64)
+        model_meta = await redis.get(keys.model_meta(model_name))
+        if model_meta is None:
+            raise ModelNotFoundError(model_name)
+        model_meta = ujson.loads(model_meta)
+        # an arm tested in the cached copy may have left a sliding window since, which is
+        # at most one refresh interval of exploring it late
+        cached_action = self._get_cached_action_with_max_ucb(model_name, context) if self.cache is not None else None
+        if cached_action is not None:
+            action = best_action_so_far = cached_action
         else:
-            untested_action = actions[untested_actions[0]]
-            self._increment_action_tries(model_name, untested_action)
-            self._update_covariance_matrix(
-                model_name, untested_action, context)
-            return untested_action
+            actions = model_meta["actions"]
+            action_tries = forgetting_from_meta(model_meta).view(
+                m.unpackb(await redis.get(keys.action_tries(model_name))), time.time()
+            )
+            untested_actions = np.nonzero(action_tries == 0)[0]
+            if untested_actions.size == 0:
+                action = best_action_so_far = await self._get_action_with_max_ucb(model_name, context)
+            else:
+                action, best_action_so_far = actions[untested_actions[0]], None
+        if claim is not None:
+            action = claim(action)
+        if action is not None:
+            await self._record_selection(model_name, model_meta, action, context)
+        return action, best_action_so_far
 
     async def reward_action(
         self, model_name: str, action: str, context: np.ndarray, reward: float = 1.0
     ) -> None:
-        model_meta = await self.redis.get(f"model_meta:{model_name}")
-        reward_matrix = m.unpackb(await self.redis.get(f"reward_matrix:{model_name}")).copy()
-        actions = ujson.loads(model_meta)["actions"]
-        if action not in actions:
-            raise ValueError(f"action {action} not recognized")
-        action_index = actions.index(action)
-        reward_matrix[action_index] += reward * context
-        await self.redis.set(f"reward_matrix:{model_name}", m.packb(reward_matrix))
+        redis = self.router.for_model(model_name)
+        model_meta = await self.get_model_meta(model_name)
+        error = self.reward_error(model_meta, action, context)
+        if error is not None:
+            raise ValueError(error)
+        action_index = model_meta["actions"].index(action)
+        forgetting = forgetting_from_meta(model_meta)
+        weighted_context = reward * np.asarray(context, dtype=np.float64)
+        await update_model_value(
+            redis,
+            model_name,
+            keys.reward_matrix(model_name),
+            lambda reward_matrix: forgetting.add(reward_matrix, action_index, weighted_context, time.time()),
+        )
+
+    async def apply_rewards(self, model_name: str, events: List[RewardEvent]) -> int:
+        """Apply a batch of reward events in one update; returns how many were new.
+
+        Rewards are summed per arm before touching the reward matrix, so a batch costs
+        one read and one write of the model state. Events reward_error rejects are dropped
+        without failing the rest of the batch.
+        """
+        redis = self.router.for_model(model_name)
+        model_meta = await redis.get(keys.model_meta(model_name))
+        if model_meta is None:
+            raise ModelNotFoundError(model_name)
+        model_meta = ujson.loads(model_meta)
+        actions = model_meta["actions"]
+        forgetting = forgetting_from_meta(model_meta)
+        reward_key = keys.reward_matrix(model_name)
+
+        async def update(pipe) -> int:
+            reward_matrix = m.unpackb(await pipe.get(reward_key))
+            if "n_features" not in model_meta:
+                model_meta["n_features"] = forgetting.view(reward_matrix, time.time()).shape[-1]
+            valid = [event for event in events if self.reward_error(model_meta, event.action, event.context) is None]
+            fresh = await filter_unapplied(redis, model_name, valid)
+            if fresh:
+                weighted_contexts = np.array([event.reward * np.asarray(event.context) for event in fresh])
+                reward_matrix = forgetting.add(
+                    reward_matrix, [actions.index(event.action) for event in fresh], weighted_contexts, time.time()
+                )
+            pipe.multi()
+            pipe.set(reward_key, m.packb(reward_matrix))
+            mark_applied(pipe, model_name, fresh)
+            touch_model(pipe, model_name)
+            return len(fresh)
+
+        return await transact(redis, [reward_key], update)
 
 
 async def main():
 
     redis = StrictRedis(host="127.0.0.1", port=6379, db=0)
-    linucb = LinUCB(redis)
+    linucb = LinUCB(RedisRouter.standalone(redis))
     model_name = "test"
     await linucb.create_model(model_name, ["a", "b", "c"], 3, 0.1)
     context = np.array([1, 0, 0])
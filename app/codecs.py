@@ -0,0 +1,114 @@
+"""Request and response encodings.
+
+Requests may be sent as
+
+* application/json: parsed with orjson,
+* application/msgpack: a map of the usual fields; `context` may be a list or
+  raw float32 little-endian bytes, or
+* application/octet-stream: the raw float32 little-endian context as the body,
+  the other fields as query parameters.
+
+Contexts are decoded straight into NumPy, with np.frombuffer for binary ones
+and one np.asarray call for lists, and handed to the route through
+request.state, bypassing pydantic's per-element parsing. Lists NumPy cannot
+read as a flat float vector are left in the fields for pydantic to reject.
+Responses are msgpack when the client accepts application/msgpack, orjson
+otherwise.
+"""
+
+from typing import Any, Callable, Optional, Tuple
+
+import msgpack
+import numpy as np
+import orjson
+from fastapi import Request, Response
+from fastapi.responses import ORJSONResponse
+from fastapi.routing import APIRoute
+from pydantic import BaseModel
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+FLOAT32 = "application/octet-stream"
+
+CONTEXT_DTYPE = np.dtype("<f4")
+
+
+def _pop_context(fields: Any) -> Optional[np.ndarray]:
+    if not isinstance(fields, dict):
+        return None
+    context = fields.get("context")
+    if isinstance(context, bytes):
+        array = np.frombuffer(context, dtype=CONTEXT_DTYPE)
+    elif isinstance(context, list):
+        try:
+            array = np.asarray(context, dtype=np.float64)
+        except (TypeError, ValueError):
+            return None
+        if array.ndim != 1:
+            return None
+    else:
+        return None
+    del fields["context"]
+    return array
+
+
+def decode_body(content_type: str, body: bytes, query: dict) -> Tuple[Any, Optional[np.ndarray]]:
+    """Decode a request body into its fields and the context array, if it has one."""
+    if content_type == FLOAT32:
+        return dict(query), np.frombuffer(body, dtype=CONTEXT_DTYPE)
+    fields = msgpack.unpackb(body) if content_type == MSGPACK else orjson.loads(body)
+    return fields, _pop_context(fields)
+
+
+class MsgpackResponse(Response):
+    media_type = MSGPACK
+
+    def render(self, content: Any) -> bytes:
+        return msgpack.packb(content)
+
+
+class NegotiatedRequest(Request):
+    def __init__(self, scope, receive):
+        super().__init__(scope, receive)
+        content_type = self.headers.get("content-type", JSON).split(";")[0].strip()
+        self.state.content_type = content_type
+        self.state.context = None
+        if content_type in (MSGPACK, FLOAT32):
+            # let FastAPI hand the body to json() below, which knows the real encoding
+            scope["headers"] = [
+                (name, JSON.encode() if name == b"content-type" else value) for name, value in scope["headers"]
+            ]
+            if hasattr(self, "_headers"):
+                del self._headers
+
+    async def json(self) -> Any:
+        if not hasattr(self, "_json"):
+            fields, context = decode_body(self.state.content_type, await self.body(), self.query_params)
+            self.state.context = context
+            self._json = fields
+        return self._json
+
+
+class NegotiatedRoute(APIRoute):
+    def get_route_handler(self) -> Callable:
+        handler = super().get_route_handler()
+
+        async def negotiated_handler(request: Request) -> Response:
+            return await handler(NegotiatedRequest(request.scope, request.receive))
+
+        return negotiated_handler
+
+
+def request_context(http_request: Request, context: Optional[list]) -> Optional[np.ndarray]:
+    """The context of a request, whichever encoding it arrived in."""
+    binary_context = getattr(http_request.state, "context", None)
+    if binary_context is not None:
+        return binary_context
+    return np.asarray(context, dtype=np.float64) if context is not None else None
+
+
+def encode_response(http_request: Request, body: BaseModel, status_code: int = 200) -> Response:
+    content = body.dict(by_alias=True)
+    if MSGPACK in http_request.headers.get("accept", ""):
+        return MsgpackResponse(content, status_code=status_code)
+    return ORJSONResponse(content, status_code=status_code)
@@ -0,0 +1,323 @@
+"""Routing of keys to Redis nodes.
+
+Three modes are supported:
+
+* standalone: every key goes to one Redis.
+* cluster: keys are routed client-side to the master owning their hash slot,
+  using the slot map from CLUSTER SLOTS. Each node is an aioredis client, so
+  pipelines, WATCH/MULTI and streams work as on a standalone Redis as long as
+  the keys involved share a hash tag. MOVED replies refresh the slot map and
+  are retried once on the new owner, so resharding and failover do not fail
+  requests until the next periodic refresh; see ClusterNodeClient.
+* sharded: model keys are spread over independent Redis nodes with a
+  consistent hash ring over their hash tag. Keys without a hash tag, which are
+  not per model, live on the first node of REDIS_NODES; keep it first when
+  changing the list.
+"""
+
+import asyncio
+import bisect
+import hashlib
+import logging
+import re
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+import aioredis
+import aioredis.client
+from aioredis import Redis
+from aioredis.exceptions import ResponseError, WatchError
+
+from app import keys
+
+CLUSTER_SLOTS = 16384
+
+logger = logging.getLogger("redis_router")
+
+
+def _crc16_table() -> List[int]:
+    table = []
+    for byte in range(256):
+        crc = byte << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else (crc << 1)
+        table.append(crc & 0xFFFF)
+    return table
+
+
+_CRC16_TABLE = _crc16_table()
+
+
+def key_slot(key: str) -> int:
+    """Redis Cluster hash slot of 'key' (CRC16/XMODEM of its hash tag)."""
+    crc = 0
+    for byte in keys.hash_tag(key).encode():
+        crc = ((crc << 8) & 0xFFFF) ^ _CRC16_TABLE[((crc >> 8) ^ byte) & 0xFF]
+    return crc % CLUSTER_SLOTS
+
+
+class HashRing:
+    """Consistent hash ring with virtual nodes, so adding a node moves ~1/n of the models."""
+
+    def __init__(self, nodes: List[str], replicas: int = 160):
+        self.nodes = list(nodes)
+        self._ring = sorted(
+            (self._hash(f"{node}#{i}"), node) for node in self.nodes for i in range(replicas)
+        )
+        self._points = [point for point, _ in self._ring]
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+    def get_node(self, value: str) -> str:
+        index = bisect.bisect(self._points, self._hash(value)) % len(self._points)
+        return self._ring[index][1]
+
+
+# transactions annotate errors: "Command # 1 (...) of pipeline caused error: ('MOVED 3999 host:port',)"
+_REDIRECTION = re.compile(r"(?:^|: \(')(MOVED|ASK) \d+ ([^\s']+):(\d+)(?:$|',\)$)")
+
+
+def redirection(error: Exception) -> Optional[Tuple[str, str]]:
+    """("MOVED" or "ASK", node url) of a cluster redirection error, None for any other error."""
+    match = _REDIRECTION.search(str(error)) if isinstance(error, ResponseError) else None
+    if match is None:
+        return None
+    kind, host, port = match.groups()
+    return kind, f"redis://{host}:{port}/0"
+
+
+class ClusterNodeClient(aioredis.Redis):
+    """Client of a cluster master that follows a MOVED or ASK redirection once."""
+
+    router: "RedisRouter"
+
+    async def execute_command(self, *args, **options):
+        try:
+            return await super().execute_command(*args, **options)
+        except ResponseError as e:
+            redirect = redirection(e)
+            if redirect is None:
+                raise
+            kind, url = redirect
+            target = await self.router.follow(kind, url)
+            if kind == "ASK":
+                # ASKING only admits the next command on the same connection
+                async with target.pipeline(transaction=False) as pipe:
+                    pipe.execute_command("ASKING")
+                    pipe.execute_command(*args, **options)
+                    return (await aioredis.client.Pipeline.execute(pipe))[1]
+            return await aioredis.Redis.execute_command(target, *args, **options)
+
+    def pipeline(self, transaction: bool = True, shard_hint: Optional[str] = None) -> "ClusterNodePipeline":
+        pipe = ClusterNodePipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+        pipe.router = self.router
+        return pipe
+
+
+class ClusterNodePipeline(aioredis.client.Pipeline):
+    """Pipeline of a ClusterNodeClient; follows MOVED redirections once.
+
+    * a redirected WATCH moves the pipeline to the new owner. Once keys are watched,
+      or when a watched transaction is redirected, WatchError is raised instead, so
+      app.utils.transact re-runs the transaction with fresh reads on the new owner.
+    * a redirected MULTI/EXEC transaction was aborted as a whole and is resent.
+    * in a plain pipeline only the redirected commands are resent, each to its new owner.
+
+    ASK redirections, which only happen while a slot is being migrated, are raised.
+    """
+
+    router: "RedisRouter"
+
+    async def _follow_moved(self, error: Exception) -> Optional[Redis]:
+        redirect = redirection(error)
+        if redirect is None or redirect[0] != "MOVED":
+            return None
+        return await self.router.follow(*redirect)
+
+    async def immediate_execute_command(self, *args, **options):
+        try:
+            return await super().immediate_execute_command(*args, **options)
+        except ResponseError as e:
+            target = await self._follow_moved(e)
+            if target is None:
+                raise
+            watching = self.watching
+            await self.reset()
+            self.connection_pool = target.connection_pool
+            if watching:
+                raise WatchError(f"watched keys moved to {target}") from e
+            return await super().immediate_execute_command(*args, **options)
+
+    async def execute(self, raise_on_error: bool = True):
+        stack, watching = list(self.command_stack), self.watching
+        if not (self.is_transaction or self.explicit_transaction):
+            return await self._execute_redirected(stack, raise_on_error)
+        try:
+            return await super().execute(raise_on_error)
+        except ResponseError as e:
+            # execute() has reset the pipeline
+            target = await self._follow_moved(e)
+            if target is None:
+                raise
+            self.connection_pool = target.connection_pool
+            if watching:
+                raise WatchError(f"watched keys moved to {target}") from e
+            self.command_stack = stack
+            return await super().execute(raise_on_error)
+
+    async def _execute_redirected(self, stack, raise_on_error: bool):
+        results = await super().execute(raise_on_error=False)
+        moved: Dict[str, List[int]] = {}
+        for i, result in enumerate(results):
+            redirect = redirection(result)
+            if redirect is not None and redirect[0] == "MOVED":
+                moved.setdefault(redirect[1], []).append(i)
+        for url, indices in moved.items():
+            target = await self.router.follow("MOVED", url)
+            async with target.pipeline(transaction=False) as pipe:
+                for i in indices:
+                    args, options = stack[i]
+                    pipe.pipeline_execute_command(*args, **options)
+                retried = await aioredis.client.Pipeline.execute(pipe, raise_on_error=False)
+            for i, result in zip(indices, retried):
+                results[i] = result
+        if raise_on_error:
+            for result in results:
+                if isinstance(result, Exception):
+                    raise result
+        return results
+
+
+class RedisRouter:
+    def __init__(self, mode: str, clients: Dict[str, Redis]):
+        self.mode = mode
+        self.clients = clients
+        self.ring = HashRing(list(clients)) if mode == "sharded" else None
+        # slot -> node url, only used in cluster mode
+        self.slots: List[Optional[str]] = [None] * CLUSTER_SLOTS
+        self._refreshing: Optional[asyncio.Future] = None
+
+    @classmethod
+    def standalone(cls, redis: Redis) -> "RedisRouter":
+        return cls("standalone", {"default": redis})
+
+    @property
+    def default(self) -> Redis:
+        return next(iter(self.clients.values()))
+
+    def node_for_key(self, key: str) -> str:
+        if self.mode == "sharded":
+            if not keys.has_hash_tag(key):
+                # global keys (the registry, the reward stream) stay on the first node, so
+                # adding nodes moves models only
+                return self.ring.nodes[0]
+            return self.ring.get_node(keys.hash_tag(key))
+        if self.mode == "cluster":
+            node = self.slots[key_slot(key)]
+            if node is None:
+                raise aioredis.exceptions.ConnectionError(f"no cluster node serves the slot of {key}")
+            return node
+        return next(iter(self.clients))
+
+    def for_key(self, key: str) -> Redis:
+        return self.clients[self.node_for_key(key)]
+
+    def for_model(self, model_name: str) -> Redis:
+        return self.for_key(keys.model_meta(model_name))
+
+    def connect(self, url: str) -> Redis:
+        """The client of the node at 'url', created on first use."""
+        if url not in self.clients:
+            if self.mode == "cluster":
+                client = ClusterNodeClient.from_url(url)
+                client.router = self
+            else:
+                client = aioredis.Redis.from_url(url)
+            self.clients[url] = client
+        return self.clients[url]
+
+    async def follow(self, kind: str, url: str) -> Redis:
+        """The client to retry a redirected command on; MOVED also means the slot map is stale."""
+        if kind == "MOVED":
+            # one refresh for all the requests redirected at the same time
+            if self._refreshing is None or self._refreshing.done():
+                self._refreshing = asyncio.ensure_future(self.refresh_slots())
+            try:
+                await asyncio.shield(self._refreshing)
+            except aioredis.exceptions.RedisError:
+                pass
+        return self.connect(url)
+
+    async def refresh_slots(self) -> None:
+        """Reload the slot map from the cluster, connecting to newly seen masters."""
+        for client in list(self.clients.values()):
+            try:
+                ranges = await client.execute_command("CLUSTER SLOTS")
+                break
+            except aioredis.exceptions.RedisError:
+                continue
+        else:
+            raise aioredis.exceptions.ConnectionError("no cluster node answered CLUSTER SLOTS")
+
+        slots: List[Optional[str]] = [None] * CLUSTER_SLOTS
+        for start, end, master, *_ in ranges:
+            host, port = master[0], master[1]
+            host = host.decode() if isinstance(host, bytes) else host
+            url = f"redis://{host}:{port}/0"
+            self.connect(url)
+            slots[start:end + 1] = [url] * (end - start + 1)
+        self.slots = slots
+
+    async def close(self) -> None:
+        for client in self.clients.values():
+            await client.close()
+            await client.connection_pool.disconnect()
+
+
+async def init_redis_router(
+    redis_mode: str,
+    redis_host: str,
+    redis_port: str,
+    redis_db: str,
+    redis_nodes: str = "",
+    cluster_refresh_seconds: float = 30,
+) -> AsyncIterator[RedisRouter]:
+    """
+    redis_nodes is a comma separated list of redis:// urls: the shards in sharded
+    mode and the seed nodes in cluster mode (REDIS_HOST/PORT if empty).
+    """
+    urls = [url.strip() for url in redis_nodes.split(",") if url.strip()]
+    if not urls or redis_mode == "standalone":
+        urls = [f"redis://{redis_host}:{redis_port}/{redis_db}"]
+    if redis_mode not in ("standalone", "cluster", "sharded"):
+        raise ValueError(f"unknown REDIS_MODE {redis_mode}")
+
+    # cluster nodes are connected through router.connect, which makes them follow redirections
+    clients = {} if redis_mode == "cluster" else {url: aioredis.Redis.from_url(url) for url in urls}
+    router = RedisRouter(redis_mode, clients)
+    for url in urls:
+        router.connect(url)
+    refresher = None
+    if redis_mode == "cluster":
+        try:
+            await router.refresh_slots()
+        except aioredis.exceptions.RedisError:
+            # keys have no node until a refresh succeeds; failing here would only restart the worker
+            logger.exception("failed to load the cluster slot map, retrying in %s seconds", cluster_refresh_seconds)
+
+        async def refresh_periodically():
+            while True:
+                await asyncio.sleep(cluster_refresh_seconds)
+                try:
+                    await router.refresh_slots()
+                except aioredis.exceptions.RedisError:
+                    pass
+
+        refresher = asyncio.create_task(refresh_periodically())
+
+    yield router
+
+    if refresher is not None:
+        refresher.cancel()
+    await router.close()
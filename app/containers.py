@@ -1,12 +1,19 @@
 """Containers module."""
 
+import os
+
+from dotenv import load_dotenv
 from dependency_injector import containers, providers
 
-import app.config.redis_pool as redis_pool
+import app.config.redis_router as redis_router
 from app.algorithms.egreedy import EGreedy
 from app.algorithms.ucb1 import UCB1
 from app.algorithms.linucb import LinUCB
 from app.services.bandit_service import BanditService
+from app.services.model_registry import ModelRegistry
+from app.services.reward_stream import RewardStream
+from app.services.selection_guard import SelectionGuard
+from app.services.shared_model_cache import init_shared_model_cache
 
 
 class Container(containers.DeclarativeContainer):
@@ -17,34 +24,103 @@ class Container(containers.DeclarativeContainer):
     # adapters
     ############
 
-    redis_pool = providers.Resource(
-        redis_pool.init_redis_pool,
+    redis_router = providers.Resource(
+        redis_router.init_redis_router,
+        redis_mode=config.redis_mode,
         redis_host=config.redis_host,
         redis_port=config.redis_port,
         redis_db=config.redis_db,
+        redis_nodes=config.redis_nodes,
+    )
+
+    shared_model_cache = providers.Resource(
+        init_shared_model_cache,
+        enabled=config.shm_cache_enabled.as_int(),
+        prefix=config.shm_cache_prefix,
     )
 
     egreedy = providers.Factory(
         EGreedy,
-        redis=redis_pool,
+        router=redis_router,
     )
 
     ucb1 = providers.Factory(
         UCB1,
-        redis=redis_pool,
+        redis=redis_router,
     )
 
     linucb = providers.Factory(
         LinUCB,
-        redis=redis_pool,
+        router=redis_router,
+        cache=shared_model_cache,
+    )
+
+    reward_stream = providers.Factory(
+        RewardStream,
+        router=redis_router,
+        stream=config.reward_stream,
+        group=config.reward_stream_group,
+        maxlen=config.reward_stream_maxlen.as_int(),
+        max_deliveries=config.reward_max_deliveries.as_int(),
     )
 
     ############
     # services
     ############
+    registry = providers.Factory(
+        ModelRegistry,
+        router=redis_router,
+    )
+
+    # one per worker: its counters and last known decisions must outlive a request
+    selection_guard = providers.Singleton(
+        SelectionGuard,
+        max_inflight=config.max_inflight_selections.as_int(),
+        budget_ms=config.select_budget_ms.as_float(),
+        fallback=config.select_fallback,
+    )
+
     bandit_service = providers.Factory(
         BanditService,
-        redis=redis_pool,
+        router=redis_router,
         egreedy=egreedy,
         linucb=linucb,
+        reward_stream=reward_stream,
+        selection_guard=selection_guard,
+        registry=registry,
+        reward_mode=config.reward_mode,
     )
+
+
+def create_container() -> Container:
+    dirpath = os.path.dirname(os.path.abspath(__file__))
+    load_dotenv(f"{dirpath}/env/{os.environ.get('ENV', 'local')}/.env")
+
+    container = Container()
+    container.config.redis_host.from_env("REDIS_HOST", "localhost")
+    container.config.redis_port.from_env("REDIS_PORT", "6379")
+    container.config.redis_db.from_env("REDIS_DB", "0")
+    # "standalone", "cluster" (REDIS_NODES are seeds) or "sharded" (REDIS_NODES are the shards)
+    container.config.redis_mode.from_env("REDIS_MODE", "standalone")
+    container.config.redis_nodes.from_env("REDIS_NODES", "")
+    # "sync" applies rewards in the request, "stream" only appends them for app.workers.reward_consumer
+    container.config.reward_mode.from_env("REWARD_MODE", "sync")
+    container.config.reward_stream.from_env("REWARD_STREAM", "reward_events")
+    container.config.reward_stream_group.from_env("REWARD_STREAM_GROUP", "reward_consumers")
+    container.config.reward_stream_maxlen.from_env("REWARD_STREAM_MAXLEN", "1000000")
+    # deliveries after which an unacknowledged reward event is moved to the "<REWARD_STREAM>:dead" stream
+    container.config.reward_max_deliveries.from_env("REWARD_MAX_DELIVERIES", "10")
+    # score hot LinUCB models from host shared memory kept current by app.workers.shm_refresher
+    container.config.shm_cache_enabled.from_env("SHM_CACHE_ENABLED", "0")
+    container.config.shm_cache_prefix.from_env("SHM_CACHE_PREFIX", "bandit")
+    # 0 disables the budget / the in-flight limit
+    container.config.select_budget_ms.from_env("SELECT_BUDGET_MS", "0")
+    container.config.max_inflight_selections.from_env("MAX_INFLIGHT_SELECTIONS", "0")
+    # "last" (the last known best arm) or "random"
+    container.config.select_fallback.from_env("SELECT_FALLBACK", "last")
+    # models loaded before the worker reports ready: a comma separated list and/or the N most used
+    container.config.prewarm_models.from_env("PREWARM_MODELS", "")
+    container.config.prewarm_top_n.from_env("PREWARM_TOP_N", "0")
+    # how often selection counts are added to keys.MODEL_USAGE, which PREWARM_TOP_N ranks by
+    container.config.usage_flush_seconds.from_env("USAGE_FLUSH_SECONDS", "10")
+    return container
@@ -0,0 +1,80 @@
+"""Redis key names.
+
+Every key of a model carries the model name as a hash tag (`{model}`), so in
+Redis Cluster all of a model's keys share one slot and can be used together in
+pipelines and transactions. The sharded mode hashes the same tag, which keeps
+a model on a single node there too.
+"""
+
+from typing import List
+
+# sorted set of all model names, scored 0 so it pages in name order with ZRANGEBYLEX
+MODEL_REGISTRY = "model_registry"
+
+# sorted set of model names scored by how many selections they served
+MODEL_USAGE = "model_usage"
+
+# keys holding a model's numpy arrays
+MODEL_STATE_PREFIXES = [
+    "action_successes",
+    "action_tries",
+    "covariance_matrices",
+    "reward_matrix",
+]
+
+MODEL_KEY_PREFIXES = ["model_meta", "model_info"] + MODEL_STATE_PREFIXES
+
+
+def hash_tag(key: str) -> str:
+    """Return the part of 'key' Redis Cluster hashes: the first non-empty `{...}`, else the key."""
+    start = key.find("{")
+    if start != -1:
+        end = key.find("}", start + 1)
+        if end > start + 1:
+            return key[start + 1:end]
+    return key
+
+
+def has_hash_tag(key: str) -> bool:
+    return hash_tag(key) != key
+
+
+def model_meta(model_name: str) -> str:
+    return f"model_meta:{{{model_name}}}"
+
+
+def model_info(model_name: str) -> str:
+    return f"model_info:{{{model_name}}}"
+
+
+def action_successes(model_name: str) -> str:
+    return f"action_successes:{{{model_name}}}"
+
+
+def action_tries(model_name: str) -> str:
+    return f"action_tries:{{{model_name}}}"
+
+
+def covariance_matrices(model_name: str) -> str:
+    return f"covariance_matrices:{{{model_name}}}"
+
+
+def reward_matrix(model_name: str) -> str:
+    return f"reward_matrix:{{{model_name}}}"
+
+
+def reward_applied(model_name: str, idempotency_key: str) -> str:
+    return f"reward_applied:{{{model_name}}}:{idempotency_key}"
+
+
+def model_keys(model_name: str) -> List[str]:
+    return [f"{prefix}:{{{model_name}}}" for prefix in MODEL_KEY_PREFIXES]
+
+
+def model_state_keys(model_name: str) -> List[str]:
+    return [f"{prefix}:{{{model_name}}}" for prefix in MODEL_STATE_PREFIXES]
+
+
+def legacy_model_keys(model_name: str) -> List[str]:
+    """Key names used before hash tags were introduced, for app.tools.migrate_models."""
+    return [f"{prefix}:{model_name}" for prefix in MODEL_KEY_PREFIXES]
@@ -1,6 +1,11 @@
-import os
+import asyncio
+import inspect
+import logging
+import time
+from typing import List, Optional
+
+import ujson
 
-from dotenv import load_dotenv
 from fastapi import (
     FastAPI,
     Response,
@@ -8,20 +13,17 @@ from fastapi import (
     Request,
     Depends,
     BackgroundTasks,
+    Header,
+    Query,
 )
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from dependency_injector.wiring import inject, Provide
 
-from app.algorithms.egreedy import EGreedy
-from app.algorithms.linucb import LinUCB
-from app.containers import Container
+from app.codecs import NegotiatedRoute, encode_response, request_context
+from app.containers import Container, create_container
 from app.models.pymodels import BanditCreateModelRequest, BanditRewardActionRequest, BanditSelectActionRequest, GeneralResponse
 from app.services.bandit_service import BanditService
 
-dirpath = os.path.dirname(os.path.abspath(__file__))
-
-load_dotenv(f"{dirpath}/env/{os.environ.get('ENV', 'local')}/.env")
-
-
 app = FastAPI(
     title="Bandit API",
     description="Bandit API",
@@ -34,7 +36,85 @@ app = FastAPI(
         "name": "Apache 2.0",
         "url": "https://www.apache.org/licenses/LICENSE-2.0.html",
     },
+    default_response_class=ORJSONResponse,
 )
+# accept msgpack and raw float32 contexts besides JSON, see app.codecs
+app.router.route_class = NegotiatedRoute
+app.state.ready = False
+
+logger = logging.getLogger("bandit_api")
+
+
+async def resolved(result):
+    # providers only return awaitables while an async resource (the Redis router) is involved
+    return await result if inspect.isawaitable(result) else result
+
+
+async def prewarm_model_names(bandit_service: BanditService) -> List[str]:
+    model_names = [name.strip() for name in container.config.prewarm_models().split(",") if name.strip()]
+    top_n = int(container.config.prewarm_top_n())
+    if top_n > 0:
+        model_names += await bandit_service.registry.most_used(top_n)
+    return list(dict.fromkeys(model_names))
+
+
+async def flush_usage(bandit_service: BanditService, interval: float) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await bandit_service.flush_usage()
+        except Exception:
+            logger.exception("failed to record model usage")
+
+
+async def warm_up(bandit_service: BanditService, started: float) -> None:
+    # failures only leave the worker cold; Redis being down must not keep it from starting
+    model_names, warmed = [], 0
+    try:
+        model_names = await prewarm_model_names(bandit_service)
+        warmed = await bandit_service.prewarm(model_names)
+    except Exception:
+        logger.exception("prewarm failed, serving with cold caches")
+    app.state.usage_flusher = asyncio.create_task(
+        flush_usage(bandit_service, float(container.config.usage_flush_seconds()))
+    )
+    app.state.ready = True
+    logger.info("ready in %.0f ms, prewarmed %d/%d models", (time.monotonic() - started) * 1000, warmed, len(model_names))
+
+
+@app.on_event("startup")
+async def startup():
+    started = time.monotonic()
+    # connect to Redis and attach the shared memory cache now instead of in the first request
+    await resolved(container.init_resources())
+    bandit_service = await resolved(container.bandit_service())
+    # /health/ready reports "starting" until the prewarm is done
+    app.state.warmer = asyncio.create_task(warm_up(bandit_service, started))
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    app.state.ready = False
+    # startup may have failed before starting them; its error is the one to report
+    for task in ("warmer", "usage_flusher"):
+        if hasattr(app.state, task):
+            getattr(app.state, task).cancel()
+    try:
+        await (await resolved(container.bandit_service())).flush_usage()
+    except Exception:
+        logger.exception("failed to record model usage")
+    await resolved(container.shutdown_resources())
+
+
+@app.get("/health/ready")
+async def health_ready(response: Response):
+    """
+    Whether this worker finished starting up and can take traffic
+    """
+    if not app.state.ready:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+        return GeneralResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, message="starting", data=None)
+    return GeneralResponse(message="OK", status_code=status.HTTP_200_OK, data={})
 
 
 @app.post("/v1/models/create", status_code=status.HTTP_201_CREATED)
@@ -47,10 +127,17 @@ async def v1_models_create_model(
     Create a model
     """
     try:
-        if request.algorithm == "egreedy":
-            await bandit_service.egreedy.create_model(request.model_name, request.actions, request.epsilon)
-        elif request.algorithm == "linucb":
-            await bandit_service.linucb.create_model(request.model_name, request.actions, request.n_features, request.alpha)
+        await bandit_service.create_model(
+            request.algorithm,
+            request.model_name,
+            request.actions,
+            request.n_features,
+            request.alpha,
+            request.epsilon,
+            request.decay_half_life,
+            request.window_seconds,
+            request.window_buckets,
+        )
     except Exception as e:
         return GeneralResponse(status_code=400, message=str(e), data=None)
     return GeneralResponse(message="OK", status_code=status.HTTP_201_CREATED, data={})
@@ -60,45 +147,160 @@ async def v1_models_create_model(
 @inject
 async def select_action(
     request: BanditSelectActionRequest,
+    http_request: Request,
+    x_latency_budget_ms: Optional[float] = Header(None, gt=0),
     bandit_service: BanditService = Depends(Provide[Container.bandit_service]),
 ):
     """
     Select an action
+
+    Answers within X-Latency-Budget-Ms (or SELECT_BUDGET_MS), with a fallback decision
+    flagged in the data if the model could not be read in time, and sheds load with 503.
     """
+    unavailable = status.HTTP_503_SERVICE_UNAVAILABLE
+    if not bandit_service.selection_guard.admit():
+        response = encode_response(http_request, GeneralResponse(status_code=unavailable, message="overloaded", data=None), unavailable)
+        response.headers["Retry-After"] = "1"
+        return response
     try:
-        if request.algorithm == "egreedy":
-            action = await bandit_service.egreedy.select_action(request.model_name)
-        elif request.algorithm == "linucb":
-            action = await bandit_service.linucb.select_action(request.model_name, request.context)
+        action, fallback = await bandit_service.select_action_within(
+            request.algorithm, request.model_name, request_context(http_request, request.context), x_latency_budget_ms
+        )
+    except asyncio.TimeoutError as e:
+        return encode_response(http_request, GeneralResponse(status_code=unavailable, message=str(e), data=None), unavailable)
     except Exception as e:
-        return GeneralResponse(status_code=400, message=str(e), data=None)
-    return GeneralResponse(message="OK", status_code=status.HTTP_201_CREATED, data={"action": action})
+        return encode_response(http_request, GeneralResponse(status_code=400, message=str(e), data=None), status.HTTP_201_CREATED)
+    return encode_response(
+        http_request,
+        GeneralResponse(message="OK", status_code=status.HTTP_201_CREATED, data={"action": action, "fallback": fallback}),
+        status.HTTP_201_CREATED,
+    )
 
 
 @app.post("/v1/models/reward-action", status_code=status.HTTP_201_CREATED)
 @inject
 async def reward_action(
     request: BanditRewardActionRequest,
+    http_request: Request,
     bandit_service: BanditService = Depends(Provide[Container.bandit_service]),
 ):
     """
     Select an action
     """
+    context = request_context(http_request, request.context)
     try:
+        if bandit_service.streams_rewards:
+            event_id = await bandit_service.publish_reward(
+                request.algorithm,
+                request.model_name,
+                request.action,
+                context=context,
+                idempotency_key=request.idempotency_key,
+            )
+            return encode_response(
+                http_request,
+                GeneralResponse(message="Accepted", status_code=status.HTTP_202_ACCEPTED, data={"event_id": event_id}),
+                status.HTTP_201_CREATED,
+            )
         if request.algorithm == "egreedy":
             # await bandit_service.create_egreedy_model(request.model_name, request.actions, request.epsilon)
             res = await bandit_service.egreedy.reward_action(request.model_name, request.action)
         elif request.algorithm == "linucb":
-            res = await bandit_service.linucb.reward_action(request.model_name, request.action, request.context)
+            res = await bandit_service.linucb.reward_action(request.model_name, request.action, context)
     except Exception as e:
-        return GeneralResponse(status_code=400, message=str(e), data=None)
-    return GeneralResponse(message="OK", status_code=status.HTTP_201_CREATED, data=res)
+        return encode_response(http_request, GeneralResponse(status_code=400, message=str(e), data=None), status.HTTP_201_CREATED)
+    return encode_response(
+        http_request, GeneralResponse(message="OK", status_code=status.HTTP_201_CREATED, data=res), status.HTTP_201_CREATED
+    )
+
+
+@app.get("/v1/models")
+@inject
+async def list_models(
+    after: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=1000),
+    bandit_service: BanditService = Depends(Provide[Container.bandit_service]),
+):
+    """
+    List models in name order, a page at a time; pass the returned cursor as `after`
+    """
+    model_names, cursor = await bandit_service.registry.page(after, limit)
+    models = await bandit_service.registry.infos(model_names)
+    return GeneralResponse(message="OK", status_code=status.HTTP_200_OK, data={"models": models, "cursor": cursor})
+
+
+@app.get("/v1/models/export")
+@inject
+async def export_models(
+    bandit_service: BanditService = Depends(Provide[Container.bandit_service]),
+):
+    """
+    Export every model with its state as newline delimited JSON
+    """
+    async def lines():
+        async for model in bandit_service.registry.export():
+            yield ujson.dumps(model) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+@app.get("/v1/models/{model_name}")
+@inject
+async def get_model(
+    model_name: str,
+    response: Response,
+    bandit_service: BanditService = Depends(Provide[Container.bandit_service]),
+):
+    """
+    Model stats: arms, tries, last update and size in Redis
+    """
+    try:
+        stats = await bandit_service.registry.stats(model_name)
+    except ValueError as e:
+        response.status_code = status.HTTP_404_NOT_FOUND
+        return GeneralResponse(status_code=status.HTTP_404_NOT_FOUND, message=str(e), data=None)
+    return GeneralResponse(message="OK", status_code=status.HTTP_200_OK, data=stats)
+
+
+@app.delete("/v1/models/{model_name}")
+@inject
+async def delete_model(
+    model_name: str,
+    response: Response,
+    bandit_service: BanditService = Depends(Provide[Container.bandit_service]),
+):
+    """
+    Delete a model and all of its keys
+    """
+    if not await bandit_service.registry.delete(model_name):
+        response.status_code = status.HTTP_404_NOT_FOUND
+        return GeneralResponse(status_code=status.HTTP_404_NOT_FOUND, message=f"model {model_name} not found", data=None)
+    return GeneralResponse(message="OK", status_code=status.HTTP_200_OK, data={})
+
+
+@app.get("/v1/selection/stats")
+@inject
+async def selection_stats(
+    bandit_service: BanditService = Depends(Provide[Container.bandit_service]),
+):
+    """
+    Fallback and load shedding counters of this worker
+    """
+    return GeneralResponse(message="OK", status_code=status.HTTP_200_OK, data=bandit_service.selection_guard.stats())
+
+
+@app.get("/v1/cache/stats")
+@inject
+async def cache_stats(
+    bandit_service: BanditService = Depends(Provide[Container.bandit_service]),
+):
+    """
+    Shared memory model cache usage of this worker
+    """
+    return GeneralResponse(message="OK", status_code=status.HTTP_200_OK, data=bandit_service.cache_stats())
 
 
-container = Container()
-container.config.redis_host.from_env("REDIS_HOST", "localhost")
-container.config.redis_port.from_env("REDIS_PORT", "6379")
-container.config.redis_db.from_env("REDIS_DB", "0")
+container = create_container()
 container.wire(modules=[
     __name__,
 ])
@@ -2,11 +2,8 @@ from decimal import Decimal
 from typing import List, Any, Union, Optional
 from datetime import datetime
 
-from pydantic_sqlalchemy import sqlalchemy_to_pydantic
 from pydantic import BaseModel, validator, constr
 
-from app.utils import format_datetime, format_precision
-
 
 def to_camel(string: str) -> str:
     words = string.split('_')
@@ -34,12 +31,16 @@ class BanditCreateModelRequest(BaseModel):
     n_actions: int
     alpha: Optional[float] = 0.1
     epsilon: Optional[float] = 0.1
+    # forget old observations: exponential decay with this half-life, or a sliding window, in seconds
+    decay_half_life: Optional[float]
+    window_seconds: Optional[float]
+    window_buckets: int = 10
 
 
 class BanditSelectActionRequest(BaseModel):
     model_name: str
     algorithm: str
-    context: Optional[List[int]]
+    context: Optional[List[float]]
 
     class Config:
         alias_generator = to_camel
@@ -51,7 +52,7 @@ class BanditRewardActionRequest(BaseModel):
     algorithm: str
     model_name: str
     action: str
-    context: Optional[List[int]]
+    context: Optional[List[float]]
 
     class Config:
         alias_generator = to_camel
@@ -63,7 +64,8 @@ class BanditRewardActionRequest(BaseModel):
     model_name: str
     algorithm: str
     action: str
-    context: Optional[List[int]]
+    context: Optional[List[float]]
+    idempotency_key: Optional[str]
 
     class Config:
         alias_generator = to_camel
@@ -73,7 +75,7 @@ class BanditRewardActionRequest(BaseModel):
 
 class ContextualBanditSelectActionRequest(BaseModel):
     model_name: str
-    context: List[int]
+    context: List[float]
 
     class Config:
         alias_generator = to_camel
@@ -83,10 +85,19 @@ class ContextualBanditSelectActionRequest(BaseModel):
 
 class ContextualBanditRewardActionRequest(BaseModel):
     model_name: str
-    context: List[int]
+    context: List[float]
     action: str
 
     class Config:
         alias_generator = to_camel
         allow_population_by_field_name = True
         orm_mode = True
+
+
+class RewardEvent(BaseModel):
+    idempotency_key: str
+    algorithm: str
+    model_name: str
+    action: str
+    context: Optional[List[float]]
+    reward: float = 1.0
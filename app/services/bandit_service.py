@@ -1,13 +1,157 @@
-from typing import List
-
-from aioredis import Redis, StrictRedis
+import asyncio
+from typing import List, Optional, Tuple
 
 from app.algorithms.egreedy import EGreedy
+from app.algorithms.forgetting import forgetting_meta
 from app.algorithms.linucb import LinUCB
+from app.config.redis_router import RedisRouter
+from app.services.model_registry import ModelRegistry
+from app.services.reward_stream import RewardStream
+from app.services.selection_guard import Decision, SelectionGuard
 
 
 class BanditService:
-    def __init__(self, redis: Redis, egreedy: EGreedy, linucb: LinUCB):
-        self.redis = redis
+    def __init__(
+        self,
+        router: RedisRouter,
+        egreedy: EGreedy,
+        linucb: LinUCB,
+        reward_stream: RewardStream,
+        selection_guard: SelectionGuard,
+        registry: ModelRegistry,
+        reward_mode: str = "sync",
+    ):
+        self.router = router
         self.egreedy = egreedy
         self.linucb = linucb
+        self.reward_stream = reward_stream
+        self.selection_guard = selection_guard
+        self.registry = registry
+        self.reward_mode = reward_mode
+
+    def algorithm(self, algorithm: str):
+        if algorithm == "egreedy":
+            return self.egreedy
+        elif algorithm == "linucb":
+            return self.linucb
+        raise ValueError(f"algorithm {algorithm} not supported")
+
+    async def create_model(
+        self,
+        algorithm: str,
+        model_name: str,
+        actions: List[str],
+        n_features: Optional[int] = None,
+        alpha: float = 0.1,
+        epsilon: float = 0.1,
+        decay_half_life: Optional[float] = None,
+        window_seconds: Optional[float] = None,
+        window_buckets: int = 10,
+    ) -> None:
+        forgetting = forgetting_meta(decay_half_life, window_seconds, window_buckets)
+        if algorithm == "linucb":
+            await self.algorithm(algorithm).create_model(model_name, actions, n_features, alpha, forgetting)
+        else:
+            await self.algorithm(algorithm).create_model(model_name, actions, epsilon, forgetting)
+        await self.registry.register(model_name, algorithm)
+
+    async def publish_reward(
+        self,
+        algorithm: str,
+        model_name: str,
+        action: str,
+        context: Optional[List[float]] = None,
+        idempotency_key: Optional[str] = None,
+    ) -> str:
+        """Check a reward the way the reward consumer will, then append it to the reward stream."""
+        bandit = self.algorithm(algorithm)
+        error = bandit.reward_error(await bandit.get_model_meta(model_name), action, context)
+        if error is not None:
+            raise ValueError(error)
+        return await self.reward_stream.publish(
+            algorithm, model_name, action, context=context, idempotency_key=idempotency_key
+        )
+
+    async def select_action(
+        self, algorithm: str, model_name: str, context: Optional[List[float]] = None, decision: Optional[Decision] = None
+    ) -> Optional[str]:
+        """The selected action; with a 'decision', the action it settled on, None if abandoned."""
+        bandit = self.algorithm(algorithm)
+        claim = decision.select if decision is not None else None
+        if algorithm == "linucb":
+            action, best_action = await bandit.select_action_and_best(model_name, context, claim)
+        else:
+            action, best_action = await bandit.select_action_and_best(model_name, claim)
+        if self.selection_guard.knows(model_name):
+            self.selection_guard.remember(model_name, action, best_action=best_action)
+        else:
+            self.selection_guard.remember(model_name, action, await bandit.get_actions(model_name), best_action)
+        return action
+
+    async def select_action_within(
+        self, algorithm: str, model_name: str, context: Optional[List[float]] = None, budget_ms: Optional[float] = None
+    ) -> Tuple[str, bool]:
+        """
+        Select within the latency budget and return the action and whether it is a fallback.
+        The caller must have been admitted by the selection guard; its slot is released
+        when the selection really finishes, which may be after a fallback was returned.
+        Raises asyncio.TimeoutError when the budget ran out and no fallback is known.
+        """
+        guard = self.selection_guard
+        decision = Decision()
+        selection = asyncio.ensure_future(self.select_action(algorithm, model_name, context, decision))
+
+        def finished(task: asyncio.Future) -> None:
+            guard.release()
+            if not task.cancelled():
+                # retrieve it so a late failure after a fallback is not reported as unhandled
+                task.exception()
+
+        selection.add_done_callback(finished)
+        done, _ = await asyncio.wait({selection}, timeout=guard.budget(budget_ms))
+        if selection in done:
+            return selection.result(), False
+        if decision.action is not None:
+            # the selection already settled on its arm and is recording it
+            return decision.action, False
+        action = guard.fallback(model_name)
+        decision.fall_back(action)
+        if action is None:
+            raise asyncio.TimeoutError(f"no decision for model {model_name} within budget")
+        return action, True
+
+    async def prewarm(self, model_names: List[str]) -> int:
+        """
+        Load what the first requests for these models would otherwise fetch: a pooled
+        connection per Redis node, the models' actions for fallback decisions and their
+        shared memory segments. Returns how many models were found.
+        """
+        await asyncio.gather(*(redis.ping() for redis in self.router.clients.values()))
+        infos = await self.registry.infos(model_names)
+
+        async def warm(info: dict) -> bool:
+            if info["algorithm"] is None:
+                return False
+            model_name = info["model_name"]
+            try:
+                actions = await self.algorithm(info["algorithm"]).get_actions(model_name)
+            except ValueError:
+                return False
+            self.selection_guard.remember(model_name, actions=actions)
+            if info["algorithm"] == "linucb" and self.linucb.cache is not None:
+                self.linucb.cache.attach(model_name)
+            return True
+
+        return sum(await asyncio.gather(*(warm(info) for info in infos)))
+
+    async def flush_usage(self) -> None:
+        await self.registry.record_usage(self.selection_guard.take_usage())
+
+    def cache_stats(self) -> dict:
+        if self.linucb.cache is None:
+            return {"enabled": False}
+        return {"enabled": True, **self.linucb.cache.stats()}
+
+    @property
+    def streams_rewards(self) -> bool:
+        return self.reward_mode == "stream"
@@ -0,0 +1,151 @@
+"""Index of all models, so they can be listed without KEYS/SCAN over the keyspace.
+
+The index is one sorted set (keys.MODEL_REGISTRY) holding every model name with
+score 0, which makes ZRANGEBYLEX a name-ordered cursor: a page costs
+O(log N + page size). Per-model details live in the model's own
+`model_info:{name}` hash, next to its other keys.
+"""
+
+import time
+from collections import defaultdict
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+import msgpack_numpy as m
+import numpy as np
+import ujson
+from aioredis import Redis
+
+from app import keys
+from app.algorithms.forgetting import forgetting_from_meta
+from app.config.redis_router import RedisRouter
+from app.utils import ModelNotFoundError
+
+
+class ModelRegistry:
+    def __init__(self, router: RedisRouter):
+        self.router = router
+
+    @property
+    def redis(self) -> Redis:
+        return self.router.for_key(keys.MODEL_REGISTRY)
+
+    async def register(self, model_name: str, algorithm: str) -> None:
+        # the model's own keys are written by the algorithm; only fill what is missing here
+        info_key = keys.model_info(model_name)
+        async with self.router.for_model(model_name).pipeline(transaction=False) as pipe:
+            pipe.hsetnx(info_key, "algorithm", algorithm)
+            pipe.hsetnx(info_key, "created_at", time.time())
+            await pipe.execute()
+        await self.redis.zadd(keys.MODEL_REGISTRY, {model_name: 0})
+
+    async def page(self, after: Optional[str] = None, limit: int = 100) -> Tuple[List[str], Optional[str]]:
+        """Up to 'limit' model names following 'after'; the second item is the cursor of the next page."""
+        names = await self.redis.zrangebylex(
+            keys.MODEL_REGISTRY, f"({after}" if after else "-", "+", start=0, num=limit
+        )
+        names = [name.decode() for name in names]
+        return names, (names[-1] if len(names) == limit else None)
+
+    def _by_node(self, model_names: List[str]) -> Dict[str, List[str]]:
+        groups = defaultdict(list)
+        for model_name in model_names:
+            groups[self.router.node_for_key(keys.model_meta(model_name))].append(model_name)
+        return groups
+
+    async def infos(self, model_names: List[str]) -> List[dict]:
+        """Registry entries of the given models, one pipeline per node."""
+        infos = {}
+        for node, names in self._by_node(model_names).items():
+            async with self.router.clients[node].pipeline(transaction=False) as pipe:
+                for model_name in names:
+                    pipe.hgetall(keys.model_info(model_name))
+                for model_name, info in zip(names, await pipe.execute()):
+                    infos[model_name] = self._info(model_name, info)
+        return [infos[model_name] for model_name in model_names]
+
+    @staticmethod
+    def _info(model_name: str, info: dict) -> dict:
+        info = {k.decode(): v.decode() for k, v in info.items()}
+        return {
+            "model_name": model_name,
+            "algorithm": info.get("algorithm"),
+            "created_at": float(info["created_at"]) if "created_at" in info else None,
+            "updated_at": float(info["updated_at"]) if "updated_at" in info else None,
+        }
+
+    async def stats(self, model_name: str) -> dict:
+        redis = self.router.for_model(model_name)
+        model_keys = keys.model_keys(model_name)
+        async with redis.pipeline(transaction=False) as pipe:
+            pipe.hgetall(keys.model_info(model_name))
+            pipe.mget(keys.model_meta(model_name), keys.action_tries(model_name))
+            for key in model_keys:
+                pipe.memory_usage(key)
+            info, (model_meta, action_tries), *sizes = await pipe.execute()
+        if model_meta is None:
+            raise ModelNotFoundError(model_name)
+        model_meta = ujson.loads(model_meta)
+        return {
+            **self._info(model_name, info),
+            "actions": model_meta["actions"],
+            "n_actions": model_meta["n_actions"],
+            "tries": float(forgetting_from_meta(model_meta).view(m.unpackb(action_tries), time.time()).sum())
+            if action_tries is not None else 0.0,
+            "bytes": sum(size or 0 for size in sizes),
+        }
+
+    @staticmethod
+    def _jsonable(value):
+        # decayed and windowed statistics are maps of arrays, see app.algorithms.forgetting
+        if isinstance(value, dict):
+            return {k: v.tolist() if isinstance(v, np.ndarray) else v for k, v in value.items()}
+        return value.tolist()
+
+    async def delete(self, model_name: str) -> bool:
+        """Remove a model with all of its keys; UNLINK frees the memory off the Redis main thread.
+
+        Reward idempotency keys are left to expire on their own.
+        """
+        deleted = await self.router.for_model(model_name).unlink(*keys.model_keys(model_name))
+        removed = await self.redis.zrem(keys.MODEL_REGISTRY, model_name)
+        await self.router.for_key(keys.MODEL_USAGE).zrem(keys.MODEL_USAGE, model_name)
+        return bool(deleted or removed)
+
+    async def record_usage(self, usage: Dict[str, int]) -> None:
+        if not usage:
+            return
+        async with self.router.for_key(keys.MODEL_USAGE).pipeline(transaction=False) as pipe:
+            for model_name, count in usage.items():
+                pipe.zincrby(keys.MODEL_USAGE, count, model_name)
+            await pipe.execute()
+
+    async def most_used(self, n: int) -> List[str]:
+        names = await self.router.for_key(keys.MODEL_USAGE).zrevrange(keys.MODEL_USAGE, 0, n - 1)
+        return [name.decode() for name in names]
+
+    async def export(self, page_size: int = 100) -> AsyncIterator[dict]:
+        """Every model with its full state, read one registry page at a time."""
+        after = None
+        while True:
+            model_names, after = await self.page(after, page_size)
+            for node, names in self._by_node(model_names).items():
+                async with self.router.clients[node].pipeline(transaction=False) as pipe:
+                    for model_name in names:
+                        pipe.hgetall(keys.model_info(model_name))
+                        pipe.mget(keys.model_meta(model_name), *keys.model_state_keys(model_name))
+                    results = await pipe.execute()
+                for model_name, info, values in zip(names, results[::2], results[1::2]):
+                    model_meta, *arrays = values
+                    if model_meta is None:
+                        continue
+                    yield {
+                        **self._info(model_name, info),
+                        "meta": ujson.loads(model_meta),
+                        **{
+                            prefix: self._jsonable(m.unpackb(value))
+                            for prefix, value in zip(keys.MODEL_STATE_PREFIXES, arrays)
+                            if value is not None
+                        },
+                    }
+            if after is None:
+                break
@@ -0,0 +1,165 @@
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import ujson
+from aioredis import Redis
+from aioredis.exceptions import ResponseError
+
+from app.config.redis_router import RedisRouter
+from app.models.pymodels import RewardEvent
+
+
+class RewardStream:
+    """Reward events appended to a Redis Stream and consumed through a consumer group.
+
+    Entries that cannot be parsed, and entries still unacknowledged after
+    'max_deliveries' deliveries, are moved to the dead letter stream
+    "<stream>:dead" with the reason, so one bad event neither crashes the
+    consumers nor is retried forever.
+    """
+
+    def __init__(self, router: RedisRouter, stream: str, group: str, maxlen: int, max_deliveries: int = 10):
+        self.router = router
+        self.stream = stream
+        self.dead_letter_stream = f"{stream}:dead"
+        self.group = group
+        self.maxlen = maxlen
+        self.max_deliveries = max_deliveries
+
+    async def publish(
+        self,
+        algorithm: str,
+        model_name: str,
+        action: str,
+        context: Optional[List[float]] = None,
+        reward: float = 1.0,
+        idempotency_key: Optional[str] = None,
+    ) -> str:
+        fields = {
+            "algorithm": algorithm,
+            "model_name": model_name,
+            "action": action,
+            "reward": reward,
+        }
+        if context is not None:
+            fields["context"] = ujson.dumps(np.asarray(context, dtype=np.float64).tolist())
+        if idempotency_key:
+            fields["idempotency_key"] = idempotency_key
+        event_id = await self.redis.xadd(self.stream, fields, maxlen=self.maxlen, approximate=True)
+        return event_id.decode()
+
+    async def ensure_group(self) -> None:
+        try:
+            await self.redis.xgroup_create(self.stream, self.group, id="0", mkstream=True)
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    async def read(
+        self, consumer: str, count: int, block: Optional[int] = None, pending: bool = False, after: str = "0"
+    ) -> List[Tuple[str, RewardEvent]]:
+        """Read a batch for 'consumer'; with 'pending' re-read its delivered but unacknowledged events after 'after'."""
+        while True:
+            response = await self.redis.xreadgroup(
+                self.group, consumer, {self.stream: after if pending else ">"}, count=count, block=block,
+            )
+            if not response or not response[0][1]:
+                return []
+            parsed = await self._parse_entries(response[0][1])
+            if parsed or not pending:
+                return parsed
+            # every entry was trimmed or invalid and is acknowledged now, so reading again goes further
+
+    async def claim_stale(
+        self, consumer: str, count: int, min_idle_ms: int, max_scanned: Optional[int] = None
+    ) -> List[Tuple[str, RewardEvent]]:
+        """Take over events left pending by consumers that stopped without acknowledging them.
+
+        The pending list is scanned in pages from its oldest entry until 'count' stale
+        events or 'max_scanned' (default 10 * count) entries were seen, so recently
+        delivered events at its head do not hide stale ones behind them.
+        """
+        max_scanned = max_scanned or 10 * count
+        deliveries: Dict[str, int] = {}
+        start, scanned = "-", 0
+        while len(deliveries) < count and scanned < max_scanned:
+            pending = await self.redis.xpending_range(self.stream, self.group, start, "+", count)
+            if not pending:
+                break
+            scanned += len(pending)
+            for p in pending:
+                if p["time_since_delivered"] >= min_idle_ms and len(deliveries) < count:
+                    deliveries[self._decode(p["message_id"])] = p["times_delivered"]
+            start = self._next_id(pending[-1]["message_id"])
+        if not deliveries:
+            return []
+        entries = await self.redis.xclaim(self.stream, self.group, consumer, min_idle_ms, list(deliveries))
+        exhausted = [
+            (event_id, fields) for event_id, fields in entries
+            if fields and deliveries.get(self._decode(event_id), 0) >= self.max_deliveries
+        ]
+        await self.dead_letter(
+            [(self._decode(event_id), fields, f"not acknowledged after {self.max_deliveries} deliveries")
+             for event_id, fields in exhausted]
+        )
+        exhausted_ids = {event_id for event_id, _ in exhausted}
+        return await self._parse_entries([entry for entry in entries if entry[0] not in exhausted_ids])
+
+    async def _parse_entries(self, entries) -> List[Tuple[str, RewardEvent]]:
+        # entries trimmed by MAXLEN come back without fields; ack them or they stay pending forever
+        trimmed = [self._decode(event_id) for event_id, fields in entries if not fields]
+        await self.ack(trimmed)
+        parsed, invalid = [], []
+        for event_id, fields in entries:
+            if not fields:
+                continue
+            try:
+                parsed.append(self._parse(self._decode(event_id), fields))
+            except (KeyError, ValueError) as e:
+                invalid.append((self._decode(event_id), fields, f"invalid event: {e!r}"))
+        await self.dead_letter(invalid)
+        return parsed
+
+    async def dead_letter(self, entries: List[Tuple[str, dict, str]]) -> None:
+        """Move (event id, raw fields, reason) entries to the dead letter stream and acknowledge them."""
+        if not entries:
+            return
+        for event_id, fields, reason in entries:
+            await self.router.for_key(self.dead_letter_stream).xadd(
+                self.dead_letter_stream,
+                {**fields, "dead_event_id": event_id, "dead_reason": reason},
+                maxlen=self.maxlen,
+                approximate=True,
+            )
+        await self.ack([event_id for event_id, _, _ in entries])
+
+    @staticmethod
+    def _decode(event_id) -> str:
+        return event_id.decode() if isinstance(event_id, bytes) else event_id
+
+    @staticmethod
+    def _next_id(event_id) -> str:
+        ms, seq = RewardStream._decode(event_id).split("-")
+        return f"{ms}-{int(seq) + 1}"
+
+    async def ack(self, event_ids: List[str]) -> None:
+        if event_ids:
+            await self.redis.xack(self.stream, self.group, *event_ids)
+
+    @property
+    def redis(self) -> Redis:
+        return self.router.for_key(self.stream)
+
+    @staticmethod
+    def _parse(event_id: str, fields: dict) -> Tuple[str, RewardEvent]:
+        fields = {k.decode(): v.decode() for k, v in fields.items()}
+        context = fields.get("context")
+        return event_id, RewardEvent(
+            # the entry id is stable across redeliveries, so it is a valid fallback key
+            idempotency_key=fields.get("idempotency_key") or event_id,
+            algorithm=fields["algorithm"],
+            model_name=fields["model_name"],
+            action=fields["action"],
+            context=ujson.loads(context) if context is not None else None,
+            reward=float(fields.get("reward", 1.0)),
+        )
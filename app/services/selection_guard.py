@@ -0,0 +1,124 @@
+import random
+from collections import Counter, OrderedDict
+from typing import Dict, List, Optional
+
+
+class Decision:
+    """The arm one request is answered with: its selection's, or the fallback's if the budget ran out first.
+
+    The selection passes its arm through select() right before recording it and
+    records the arm returned instead, so the model counts the try (or the LinUCB
+    covariance update) for the arm the client was served and will reward, and
+    nothing for a request answered with an error.
+    """
+
+    def __init__(self):
+        self.action: Optional[str] = None
+        self.abandoned = False
+
+    def select(self, action: str) -> Optional[str]:
+        if self.action is None and not self.abandoned:
+            self.action = action
+        return self.action
+
+    def fall_back(self, action: Optional[str]) -> None:
+        """Answer with 'action' instead, or with an error if it is None."""
+        if action is None:
+            self.abandoned = True
+        self.action = action
+
+
+class SelectionGuard:
+    """Per-worker latency budget, fallback decisions and admission control for action selection.
+
+    A selection that does not finish within its budget is answered from what this
+    worker last saw of the model: the last known best arm (the greedy arm of its
+    latest selection, not the possibly exploratory arm served), or a uniformly
+    random arm. The selection itself keeps running and records the arm that was
+    served (see Decision), and it holds its in-flight slot until it finishes; once
+    'max_inflight' slots are taken, new selections are shed instead of queueing
+    behind a slow Redis.
+    """
+
+    def __init__(self, max_inflight: int = 0, budget_ms: float = 0, fallback: str = "last", max_models: int = 10000):
+        self.max_inflight = max_inflight
+        self.budget_ms = budget_ms
+        # "last": the last known best arm of the model, "random": a uniformly random arm
+        self.fallback_mode = fallback
+        self.max_models = max_models
+        self.inflight = 0
+        # admitted requests, each answered by a selection, a fallback or an error
+        self.requests = 0
+        # selections that finished, including those that finished after a fallback was returned
+        self.selections = 0
+        # selections whose budget ran out, answered with a fallback or, for models not seen yet, a 503
+        self.timeouts = 0
+        self.fallbacks = 0
+        self.shed = 0
+        # model name -> (actions, last known best action), least recently used first
+        self.models: "OrderedDict[str, tuple]" = OrderedDict()
+        # selections per model since the last take_usage(), for the registry's most used models
+        self.usage: Counter = Counter()
+
+    def admit(self) -> bool:
+        if self.max_inflight and self.inflight >= self.max_inflight:
+            self.shed += 1
+            return False
+        self.inflight += 1
+        self.requests += 1
+        return True
+
+    def release(self) -> None:
+        self.inflight -= 1
+
+    def budget(self, requested_ms: Optional[float] = None) -> Optional[float]:
+        """Budget in seconds, the tighter of the requested and configured ones; None if unbounded."""
+        budgets = [ms for ms in (requested_ms, self.budget_ms) if ms is not None and ms > 0]
+        return min(budgets) / 1000 if budgets else None
+
+    def knows(self, model_name: str) -> bool:
+        return model_name in self.models
+
+    def remember(
+        self,
+        model_name: str,
+        action: Optional[str] = None,
+        actions: Optional[List[str]] = None,
+        best_action: Optional[str] = None,
+    ) -> None:
+        """Record a finished selection of 'action'; 'best_action' is the greedy arm, if known."""
+        if action is not None:
+            self.selections += 1
+            self.usage[model_name] += 1
+        known_actions, known_best_action = self.models.get(model_name, (None, None))
+        self.models[model_name] = (actions or known_actions, best_action or known_best_action)
+        self.models.move_to_end(model_name)
+        while len(self.models) > self.max_models:
+            self.models.popitem(last=False)
+
+    def fallback(self, model_name: str) -> Optional[str]:
+        """The action to answer with once the budget ran out, None if the model was not seen yet."""
+        self.timeouts += 1
+        if model_name not in self.models:
+            return None
+        self.fallbacks += 1
+        actions, best_action = self.models[model_name]
+        if self.fallback_mode == "last" and best_action is not None:
+            return best_action
+        return random.choice(actions)
+
+    def take_usage(self) -> Dict[str, int]:
+        usage, self.usage = self.usage, Counter()
+        return usage
+
+    def stats(self) -> dict:
+        return {
+            "inflight": self.inflight,
+            "requests": self.requests,
+            "selections": self.selections,
+            "timeouts": self.timeouts,
+            "fallbacks": self.fallbacks,
+            "shed": self.shed,
+            "timeout_rate": self.timeouts / max(1, self.requests),
+            "fallback_rate": self.fallbacks / max(1, self.requests),
+        }
@@ -0,0 +1,273 @@
+"""Host-local model cache in shared memory.
+
+One refresher process (app.workers.shm_refresher) loads hot models from Redis
+and publishes them into one shared memory segment per model; every API worker
+on the host attaches the segments and scores from read-only NumPy views over
+them instead of reading and unpacking the model state from Redis. Updates
+after a selection still go to Redis.
+
+Segment layout, all little-endian:
+
+    header    8 x int64: seq, retired, meta_version, meta_len, n_arrays, updated_at_ns, -, meta_capacity
+    meta      meta_capacity bytes of JSON
+    shapes    n_arrays x 4 x int64 (ndim followed by up to 3 dims)
+    arrays    float64 payloads, back to back
+
+Readers and the writer coordinate with a seqlock: the writer makes `seq` odd
+while it writes and even when done, and a reader only trusts a result computed
+while `seq` stayed at the same even value. A segment whose layout no longer
+fits is marked retired and unlinked; readers then attach its replacement.
+"""
+
+import hashlib
+import json
+import sys
+import time
+from multiprocessing import resource_tracker, shared_memory
+from typing import Callable, Dict, List, Optional, TypeVar
+
+import numpy as np
+
+SEQ, RETIRED, META_VERSION, META_LEN, N_ARRAYS, UPDATED_AT, _, META_CAPACITY = range(8)
+HEADER_SIZE = 8 * 8
+SHAPE_SIZE = 4 * 8
+MAX_READ_ATTEMPTS = 64
+
+T = TypeVar("T")
+
+
+def segment_name(prefix: str, model_name: str) -> str:
+    # short names: macOS caps POSIX shared memory names at 31 characters
+    return f"{prefix}-{hashlib.md5(model_name.encode()).hexdigest()[:16]}"
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    # attaching registers the segment with this process' resource tracker, which
+    # would unlink it when the process exits; only the refresher owns segments
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    segment = shared_memory.SharedMemory(name=name)
+    resource_tracker.unregister(segment._name, "shared_memory")
+    return segment
+
+
+class _Segment:
+    def __init__(self, shm: shared_memory.SharedMemory):
+        self.shm = shm
+        self.header = np.ndarray((8,), dtype="<i8", buffer=shm.buf)
+        self.meta: Optional[dict] = None
+        self.meta_version = -1
+        self.views: Optional[List[np.ndarray]] = None
+
+    def layout(self) -> List[np.ndarray]:
+        """Build the array views from the shapes table, once the writer has published it."""
+        n_arrays = int(self.header[N_ARRAYS])
+        meta_end = HEADER_SIZE + self.meta_capacity
+        shapes = np.ndarray((n_arrays, 4), dtype="<i8", buffer=self.shm.buf, offset=meta_end)
+        offset = meta_end + n_arrays * SHAPE_SIZE
+        self.views = []
+        for ndim, *dims in shapes.tolist():
+            shape = tuple(dims[:ndim])
+            view = np.ndarray(shape, dtype="<f8", buffer=self.shm.buf, offset=offset)
+            view.flags.writeable = False
+            self.views.append(view)
+            offset += view.nbytes
+        return self.views
+
+    @property
+    def meta_capacity(self) -> int:
+        return int(self.header[META_CAPACITY])
+
+    def read_meta(self) -> dict:
+        version = int(self.header[META_VERSION])
+        if version != self.meta_version:
+            meta_len = int(self.header[META_LEN])
+            self.meta = json.loads(bytes(self.shm.buf[HEADER_SIZE:HEADER_SIZE + meta_len]))
+            self.meta_version = version
+        return self.meta
+
+    def close(self) -> None:
+        self.views = []
+        self.header = None
+        try:
+            self.shm.close()
+        except BufferError:
+            # a caller still holds a view; the mapping goes away with it
+            pass
+
+
+class SharedModelCache:
+    """Reader side, one per API worker."""
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self.segments: Dict[str, _Segment] = {}
+        self.hits = 0
+        self.misses = 0
+        # Redis reads the callers did not send because a cached result was used, as published
+        # by the refresher in each model's meta ("redis_commands", "redis_bytes")
+        self.redis_reads_avoided = 0
+        self.redis_commands_avoided = 0
+        self.redis_bytes_avoided = 0
+
+    def attach(self, model_name: str) -> bool:
+        """Attach the model's segment ahead of its first read; True if it is published."""
+        return self._segment(model_name) is not None
+
+    def _segment(self, model_name: str) -> Optional[_Segment]:
+        segment = self.segments.get(model_name)
+        if segment is not None and not segment.header[RETIRED]:
+            return segment
+        if segment is not None:
+            segment.close()
+            del self.segments[model_name]
+        try:
+            segment = _Segment(_attach(segment_name(self.prefix, model_name)))
+        except (FileNotFoundError, ValueError):
+            return None
+        self.segments[model_name] = segment
+        return segment
+
+    def read(self, model_name: str, func: Callable[[dict, List[np.ndarray]], T]) -> Optional[T]:
+        """Call 'func(meta, arrays)' on a consistent snapshot of the model.
+
+        Returns None if the model is not cached, or if no consistent snapshot could
+        be taken because the refresher kept rewriting it. The arrays are views into
+        shared memory: 'func' must not keep references to them. A result other than
+        None is taken to replace the caller's Redis read and counted as avoided.
+        """
+        for _ in range(MAX_READ_ATTEMPTS):
+            segment = self._segment(model_name)
+            if segment is None:
+                break
+            seq = int(segment.header[SEQ])
+            # 0: created but never published, odd: being written
+            if seq == 0 or seq & 1:
+                continue
+            try:
+                meta = segment.read_meta()
+                result = func(meta, segment.views or segment.layout())
+            except Exception:
+                # a torn read can produce any garbage; only trust it if seq says otherwise
+                if int(segment.header[SEQ]) == seq:
+                    raise
+                result = None
+            if int(segment.header[SEQ]) == seq:
+                self.hits += 1
+                if result is not None:
+                    self.redis_reads_avoided += 1
+                    self.redis_commands_avoided += meta.get("redis_commands", 0)
+                    self.redis_bytes_avoided += meta.get("redis_bytes", 0)
+                return result
+            # the parsed meta may be torn as well
+            segment.meta_version = -1
+        self.misses += 1
+        return None
+
+    def stats(self) -> dict:
+        return {
+            "models": len(self.segments),
+            "shared_bytes": sum(segment.shm.size for segment in self.segments.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "redis_reads_avoided": self.redis_reads_avoided,
+            "redis_commands_avoided": self.redis_commands_avoided,
+            "redis_bytes_avoided": self.redis_bytes_avoided,
+        }
+
+    def close(self) -> None:
+        for segment in self.segments.values():
+            segment.close()
+        self.segments = {}
+
+
+class SharedModelWriter:
+    """Writer side, owned by the single refresher process of a host."""
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self.segments: Dict[str, _Segment] = {}
+        self.meta_bytes: Dict[str, bytes] = {}
+
+    def _create(self, model_name: str, meta: bytes, arrays: List[np.ndarray]) -> _Segment:
+        name = segment_name(self.prefix, model_name)
+        old = self.segments.pop(model_name, None)
+        if old is None:
+            try:
+                # left behind by a previous refresher; attach tracked so unlink balances it
+                old = _Segment(shared_memory.SharedMemory(name=name))
+            except FileNotFoundError:
+                old = None
+        if old is not None:
+            old.header[RETIRED] = 1
+            old.shm.unlink()
+            old.close()
+
+        meta_capacity = 2 * len(meta) + 256
+        size = HEADER_SIZE + meta_capacity + len(arrays) * SHAPE_SIZE + sum(a.size * 8 for a in arrays)
+        shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        header = np.ndarray((8,), dtype="<i8", buffer=shm.buf)
+        header[SEQ] = 1
+        header[N_ARRAYS] = len(arrays)
+        header[META_CAPACITY] = meta_capacity
+        shapes = np.ndarray((len(arrays), 4), dtype="<i8", buffer=shm.buf, offset=HEADER_SIZE + meta_capacity)
+        for row, array in zip(shapes, arrays):
+            row[:] = 0
+            row[0] = array.ndim
+            row[1:1 + array.ndim] = array.shape
+        del header, shapes
+        segment = _Segment(shm)
+        for view in segment.layout():
+            view.flags.writeable = True
+        self.segments[model_name] = segment
+        self.meta_bytes.pop(model_name, None)
+        return segment
+
+    def _fits(self, segment: _Segment, meta: bytes, arrays: List[np.ndarray]) -> bool:
+        return (
+            len(meta) <= segment.meta_capacity
+            and len(segment.views) == len(arrays)
+            and all(view.shape == array.shape for view, array in zip(segment.views, arrays))
+        )
+
+    def publish(self, model_name: str, meta: dict, arrays: List[np.ndarray]) -> int:
+        """Write a new version of the model; returns the segment size in bytes."""
+        meta_bytes = json.dumps(meta).encode()
+        segment = self.segments.get(model_name)
+        if segment is None or not self._fits(segment, meta_bytes, arrays):
+            segment = self._create(model_name, meta_bytes, arrays)
+
+        header = segment.header
+        if not header[SEQ] & 1:
+            header[SEQ] += 1
+        if self.meta_bytes.get(model_name) != meta_bytes:
+            segment.shm.buf[HEADER_SIZE:HEADER_SIZE + len(meta_bytes)] = meta_bytes
+            header[META_LEN] = len(meta_bytes)
+            header[META_VERSION] += 1
+            self.meta_bytes[model_name] = meta_bytes
+        for view, array in zip(segment.views, arrays):
+            view[...] = array
+        header[UPDATED_AT] = time.time_ns()
+        header[SEQ] += 1
+        return segment.shm.size
+
+    def drop(self, model_name: str) -> None:
+        segment = self.segments.pop(model_name, None)
+        if segment is not None:
+            segment.header[RETIRED] = 1
+            segment.shm.unlink()
+            segment.close()
+        self.meta_bytes.pop(model_name, None)
+
+    def close(self) -> None:
+        for model_name in list(self.segments):
+            self.drop(model_name)
+
+
+def init_shared_model_cache(enabled: int, prefix: str):
+    if not enabled:
+        yield None
+        return
+    cache = SharedModelCache(prefix)
+    yield cache
+    cache.close()
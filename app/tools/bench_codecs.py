@@ -0,0 +1,75 @@
+"""Parse + serialize cost of one select-action call per request encoding.
+
+Measures what the API does around the model: decoding the body into the
+request model and a NumPy context, and encoding the response. No Redis needed:
+
+    python -m app.tools.bench_codecs --dims 16,256,2048
+"""
+
+import argparse
+import json
+import timeit
+
+import msgpack
+import numpy as np
+import orjson
+from fastapi.encoders import jsonable_encoder
+
+from app.codecs import FLOAT32, JSON, MSGPACK, decode_body
+from app.models.pymodels import BanditSelectActionRequest, GeneralResponse
+
+RESPONSE = GeneralResponse(message="OK", status_code=201, data={"action": "left", "fallback": False})
+
+
+def stdlib_json(body: bytes) -> bytes:
+    """The previous path: json + pydantic List parsing + default JSON response."""
+    request = BanditSelectActionRequest(**json.loads(body))
+    np.asarray(request.context, dtype=np.float64)
+    return json.dumps(jsonable_encoder(RESPONSE)).encode()
+
+
+def orjson_json(body: bytes) -> bytes:
+    fields, context = decode_body(JSON, body, {})
+    BanditSelectActionRequest(**fields)
+    return orjson.dumps(RESPONSE.dict(by_alias=True))
+
+
+def msgpack_float32(body: bytes) -> bytes:
+    fields, context = decode_body(MSGPACK, body, {})
+    BanditSelectActionRequest(**fields)
+    return msgpack.packb(RESPONSE.dict(by_alias=True))
+
+
+def raw_float32(body: bytes, query: dict) -> bytes:
+    fields, context = decode_body(FLOAT32, body, query)
+    BanditSelectActionRequest(**fields)
+    return orjson.dumps(RESPONSE.dict(by_alias=True))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark request/response encodings")
+    parser.add_argument("--dims", default="16,256,2048")
+    parser.add_argument("--number", type=int, default=2000)
+    args = parser.parse_args()
+
+    query = {"model_name": "bench", "algorithm": "linucb"}
+    print(f"{'d':>6} {'encoding':>16} {'bytes':>8} {'us/request':>11}")
+    for d in [int(dim) for dim in args.dims.split(",")]:
+        context = np.random.rand(d).astype("<f4")
+        json_body = json.dumps({**query, "context": context.tolist()}).encode()
+        cases = [
+            ("json (stdlib)", len(json_body), lambda: stdlib_json(json_body)),
+            ("json (orjson)", len(json_body), lambda: orjson_json(json_body)),
+        ]
+        msgpack_body = msgpack.packb({**query, "context": context.tobytes()})
+        cases.append(("msgpack float32", len(msgpack_body), lambda: msgpack_float32(msgpack_body)))
+        raw_body = context.tobytes()
+        cases.append(("raw float32", len(raw_body), lambda: raw_float32(raw_body, query)))
+
+        for name, size, func in cases:
+            seconds = min(timeit.repeat(func, number=args.number, repeat=3)) / args.number
+            print(f"{d:>6} {name:>16} {size:>8} {seconds * 1e6:>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
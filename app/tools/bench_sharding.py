@@ -0,0 +1,96 @@
+"""Throughput of select/reward calls as models are sharded over more Redis nodes.
+
+Start a few local instances and pass them all; the benchmark runs with the
+first 1, 2, ..., n of them:
+
+    for port in 6380 6381 6382 6383; do redis-server --port $port --save "" --daemonize yes; done
+    python -m app.tools.bench_sharding --nodes redis://127.0.0.1:6380/0,redis://127.0.0.1:6381/0,...
+
+Client-side work is spread over --processes worker processes so the Python
+client does not become the bottleneck before Redis does.
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import random
+import time
+from typing import List
+
+import aioredis
+import numpy as np
+
+from app import keys
+from app.algorithms.egreedy import EGreedy
+from app.algorithms.linucb import LinUCB
+from app.config.redis_router import RedisRouter
+
+
+def make_router(urls: List[str]) -> RedisRouter:
+    return RedisRouter("sharded", {url: aioredis.Redis.from_url(url) for url in urls})
+
+
+async def setup(urls: List[str], n_models: int, n_features: int) -> None:
+    router = make_router(urls)
+    linucb = LinUCB(router)
+    egreedy = EGreedy(router)
+    for i in range(n_models):
+        for model_name in (f"bench-linucb-{i}", f"bench-egreedy-{i}"):
+            await router.for_model(model_name).unlink(*keys.model_keys(model_name))
+        await linucb.create_model(f"bench-linucb-{i}", ["a", "b", "c", "d"], n_features)
+        await egreedy.create_model(f"bench-egreedy-{i}", ["a", "b", "c", "d"])
+    await router.close()
+
+
+async def drive(urls: List[str], n_models: int, n_features: int, concurrency: int, seconds: float) -> int:
+    router = make_router(urls)
+    linucb = LinUCB(router)
+    egreedy = EGreedy(router)
+    deadline = time.monotonic() + seconds
+    done = 0
+
+    async def loop():
+        nonlocal done
+        while time.monotonic() < deadline:
+            i = random.randrange(n_models)
+            context = np.random.rand(n_features)
+            action = await linucb.select_action(f"bench-linucb-{i}", context)
+            await linucb.reward_action(f"bench-linucb-{i}", action, context)
+            action = await egreedy.select_action(f"bench-egreedy-{i}")
+            await egreedy.reward_action(f"bench-egreedy-{i}", action)
+            done += 4
+
+    await asyncio.gather(*(loop() for _ in range(concurrency)))
+    await router.close()
+    return done
+
+
+def drive_process(args) -> int:
+    return asyncio.run(drive(*args))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark throughput against the number of Redis shards")
+    parser.add_argument("--nodes", required=True, help="comma separated redis:// urls")
+    parser.add_argument("--models", type=int, default=200)
+    parser.add_argument("--features", type=int, default=16)
+    parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--concurrency", type=int, default=32, help="in-flight calls per process")
+    parser.add_argument("--seconds", type=float, default=10)
+    args = parser.parse_args()
+
+    urls = [url.strip() for url in args.nodes.split(",") if url.strip()]
+    print(f"{'nodes':>5} {'ops/s':>10} {'speedup':>8}")
+    baseline = None
+    for n in range(1, len(urls) + 1):
+        asyncio.run(setup(urls[:n], args.models, args.features))
+        job = (urls[:n], args.models, args.features, args.concurrency, args.seconds)
+        with multiprocessing.Pool(args.processes) as pool:
+            ops = sum(pool.map(drive_process, [job] * args.processes))
+        throughput = ops / args.seconds
+        baseline = baseline or throughput
+        print(f"{n:>5} {throughput:>10.0f} {throughput / baseline:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""Import time breakdown of the API worker, from `python -X importtime`.
+
+    python -m app.tools.import_report            # what `import app.main` costs
+    python -m app.tools.import_report --module app.workers.reward_consumer
+
+Prints the total, the self time summed per top-level package, and the
+slowest imports by cumulative time.
+"""
+
+import argparse
+import subprocess
+import sys
+from collections import defaultdict
+from typing import List, Tuple
+
+
+def import_times(module: str) -> List[Tuple[str, int, int]]:
+    """(module, self us, cumulative us) of every import done by `import module` in a fresh interpreter."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, check=True,
+    )
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        rows.append((name.strip(), int(self_us), int(cumulative_us)))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report import time per package")
+    parser.add_argument("--module", default="app.main")
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+
+    rows = import_times(args.module)
+    total = next(cumulative for name, _, cumulative in rows if name == args.module)
+    print(f"import {args.module}: {total / 1000:.1f} ms\n")
+
+    by_package = defaultdict(int)
+    for name, self_us, _ in rows:
+        by_package[name.split(".")[0]] += self_us
+    print(f"{'package':<30} {'self ms':>8}")
+    for package, self_us in sorted(by_package.items(), key=lambda item: -item[1])[:args.top]:
+        print(f"{package:<30} {self_us / 1000:>8.1f}")
+
+    print(f"\n{'module':<50} {'cumulative ms':>14}")
+    for name, _, cumulative_us in sorted(rows, key=lambda row: -row[2])[1:args.top + 1]:
+        print(f"{name:<50} {cumulative_us / 1000:>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""Move models to the node and key names the current Redis configuration expects.
+
+Covers two cases:
+
+* keys written before hash tags (`model_meta:hello`) are renamed to the tagged
+  form (`model_meta:{hello}`), and
+* after nodes are added to or removed from REDIS_NODES in sharded mode, models
+  are moved to the node the hash ring now assigns them, and the global keys
+  (the model registry, model usage and the reward stream with its consumer
+  groups) to the first node, where sharded mode keeps them.
+
+Run it with the same environment as the API:
+
+    REDIS_MODE=sharded REDIS_NODES=redis://a:6379/0,redis://b:6379/0 \\
+        python -m app.tools.migrate_models --from redis://old:6379/0 --from redis://a:6379/0
+
+Without --from the configured nodes themselves are scanned. Stop the reward
+consumers first: reward idempotency keys are short lived and not moved, and a
+reward stream is only moved onto a node where it is missing or empty.
+
+With --reindex every model found is also added to the model registry, which
+back-fills the registry for models created before it existed.
+"""
+
+import argparse
+import asyncio
+from typing import Dict, List
+
+import aioredis
+import ujson
+from aioredis import Redis
+
+from app import keys
+from app.config.redis_router import RedisRouter
+from app.containers import create_container
+from app.services.model_registry import ModelRegistry
+
+META_PREFIX = "model_meta:"
+
+
+async def node_id(redis: Redis) -> str:
+    return (await redis.info("server"))["run_id"]
+
+
+async def migrate_model(
+    router: RedisRouter, source: Redis, model_name: str, source_keys: List[str], node_ids: Dict[int, str], dry_run: bool
+) -> bool:
+    target = router.for_model(model_name)
+    target_keys = keys.model_keys(model_name)
+    # in cluster mode every key lives on the master owning its slot, even legacy ones
+    sources = [router.for_key(key) if router.mode == "cluster" else source for key in source_keys]
+
+    for redis in sources + [target]:
+        if id(redis) not in node_ids:
+            node_ids[id(redis)] = await node_id(redis)
+    if source_keys == target_keys and all(node_ids[id(redis)] == node_ids[id(target)] for redis in sources):
+        return False
+    if dry_run:
+        return True
+
+    dumps = []
+    for redis, key in zip(sources, source_keys):
+        dumps.append((await redis.dump(key), await redis.pttl(key)))
+
+    async with target.pipeline(transaction=True) as pipe:
+        for target_key, (value, ttl) in zip(target_keys, dumps):
+            if value is not None:
+                pipe.restore(target_key, max(ttl, 0), value, replace=True)
+        await pipe.execute()
+
+    for redis, source_key, target_key in zip(sources, source_keys, target_keys):
+        if source_key != target_key or node_ids[id(redis)] != node_ids[id(target)]:
+            await redis.unlink(source_key)
+    return True
+
+
+async def migrate_global_key(
+    router: RedisRouter, sources: List[Redis], key: str, node_ids: Dict[int, str], dry_run: bool
+) -> int:
+    """Move 'key' from 'sources' to the node it is routed to; sorted sets found on several nodes are merged."""
+    target = router.for_key(key)
+    moved = 0
+    for source in sources:
+        if node_ids[id(source)] == node_ids[id(target)] or not await source.exists(key):
+            continue
+        if dry_run:
+            moved += 1
+            continue
+        key_type = (await source.type(key)).decode()
+        if not await target.exists(key) or (key_type == "stream" and await target.xlen(key) == 0):
+            value, ttl = await source.dump(key), await source.pttl(key)
+            await target.restore(key, max(ttl, 0), value, replace=True)
+        elif key_type == "zset":
+            # registry scores are all 0 and usage scores are counts, so adding them up merges both
+            async with target.pipeline(transaction=True) as pipe:
+                for member, score in await source.zrange(key, 0, -1, withscores=True):
+                    pipe.zincrby(key, score, member)
+                await pipe.execute()
+        else:
+            print(f"left {key} on node {node_ids[id(source)]}: the target node has a non-empty one too")
+            continue
+        await source.unlink(key)
+        moved += 1
+    return moved
+
+
+async def reindex_model(router: RedisRouter, registry: ModelRegistry, model_name: str) -> None:
+    model_meta = await router.for_model(model_name).get(keys.model_meta(model_name))
+    if model_meta is not None:
+        await registry.register(model_name, "linucb" if "alpha" in ujson.loads(model_meta) else "egreedy")
+
+
+async def run(sources: List[str], dry_run: bool, reindex: bool) -> None:
+    container = create_container()
+    await container.init_resources()
+    try:
+        router = await container.redis_router()
+        registry = await container.registry()
+        clients = [aioredis.Redis.from_url(url) for url in sources] or list(router.clients.values())
+        node_ids: Dict[int, str] = {}
+        moved = 0
+        for source in clients:
+            async for meta_key in source.scan_iter(match=f"{META_PREFIX}*", count=1000):
+                meta_key = meta_key.decode()
+                model_name = meta_key[len(META_PREFIX):]
+                if model_name.startswith("{") and model_name.endswith("}"):
+                    model_name = model_name[1:-1]
+                    source_keys = keys.model_keys(model_name)
+                else:
+                    source_keys = keys.legacy_model_keys(model_name)
+                if await migrate_model(router, source, model_name, source_keys, node_ids, dry_run):
+                    moved += 1
+                    print(f"{'would move' if dry_run else 'moved'} {model_name}")
+                if reindex and not dry_run:
+                    await reindex_model(router, registry, model_name)
+        print(f"{moved} models {'to move' if dry_run else 'moved'}")
+        if router.mode == "sharded":
+            nodes = clients + [client for client in router.clients.values() if client not in clients]
+            for redis in nodes:
+                if id(redis) not in node_ids:
+                    node_ids[id(redis)] = await node_id(redis)
+            for key in (keys.MODEL_REGISTRY, keys.MODEL_USAGE, container.config.reward_stream()):
+                if await migrate_global_key(router, nodes, key, node_ids, dry_run):
+                    print(f"{'would move' if dry_run else 'moved'} {key}")
+        if sources:
+            for client in clients:
+                await client.close()
+    finally:
+        await container.shutdown_resources()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rename and rebalance bandit models across Redis nodes")
+    parser.add_argument("--from", dest="sources", action="append", default=[], help="redis:// url to scan, repeatable")
+    parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument("--reindex", action="store_true", help="add every model found to the model registry")
+    args = parser.parse_args()
+    asyncio.run(run(args.sources, args.dry_run, args.reindex))
+
+
+if __name__ == "__main__":
+    main()
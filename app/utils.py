@@ -1,11 +1,16 @@
 import json
+import time
 from typing import Union, Dict
 from datetime import datetime
 from decimal import Decimal
 
 from aioredis import Redis
+from aioredis.exceptions import WatchError
 import struct
 import numpy as np
+import msgpack_numpy as m
+
+from app import keys
 
 
 def format_datetime(value: datetime):
@@ -68,3 +73,61 @@ async def load_np_from_redis(r: Redis, key) -> np.ndarray:
     # Add slicing here, or else the array would differ from the original
     a = np.frombuffer(encoded[8:]).reshape(h, w)
     return a
+
+
+async def transact(r: Redis, keys, func, retries: int = 32):
+    """Run 'func(pipe)' under WATCH on 'keys' and retry if a concurrent writer touched them.
+
+    'func' reads through the pipeline in immediate mode, then calls 'pipe.multi()'
+    and queues its writes; the queued writes are executed atomically.
+    """
+    async with r.pipeline(transaction=True) as pipe:
+        for _ in range(retries):
+            try:
+                await pipe.watch(*keys)
+                result = await func(pipe)
+                await pipe.execute()
+                return result
+            except WatchError:
+                continue
+    raise WatchError(f"gave up after {retries} conflicting updates on {keys}")
+
+
+class ModelNotFoundError(ValueError):
+    def __init__(self, model_name: str):
+        super().__init__(f"model {model_name} not found")
+
+
+REWARD_IDEMPOTENCY_TTL = 24 * 60 * 60
+
+
+async def filter_unapplied(r: Redis, model_name: str, events):
+    """Drop reward events whose idempotency key was already applied to 'model_name'."""
+    events = list({event.idempotency_key: event for event in events}.values())
+    pipe = r.pipeline(transaction=False)
+    for event in events:
+        pipe.exists(keys.reward_applied(model_name, event.idempotency_key))
+    applied = await pipe.execute()
+    return [event for event, seen in zip(events, applied) if not seen]
+
+
+def mark_applied(pipe, model_name: str, events) -> None:
+    for event in events:
+        pipe.set(keys.reward_applied(model_name, event.idempotency_key), 1, ex=REWARD_IDEMPOTENCY_TTL)
+
+
+def touch_model(pipe, model_name: str) -> None:
+    """Record the time of the latest update of a model, for the model registry."""
+    pipe.hset(keys.model_info(model_name), "updated_at", time.time())
+
+
+async def update_model_value(r: Redis, model_name: str, key: str, func) -> None:
+    """Replace one of a model's keys with 'func(current value)' atomically and record the update time."""
+
+    async def update(pipe) -> None:
+        value = func(m.unpackb(await pipe.get(key)))
+        pipe.multi()
+        pipe.set(key, m.packb(value))
+        touch_model(pipe, model_name)
+
+    await transact(r, [key], update)
@@ -0,0 +1,117 @@
+"""Reward consumer: applies rewards appended to the reward stream in batches.
+
+Run one or more of these next to the API when REWARD_MODE=stream:
+
+    python -m app.workers.reward_consumer --consumer worker-1
+
+Events are acknowledged only after their update is committed, so a crashed
+consumer's batch is redelivered; idempotency keys make the redelivery harmless.
+Events that cannot be parsed, or are redelivered REWARD_MAX_DELIVERIES times
+without being applied, are moved to the "<REWARD_STREAM>:dead" stream.
+"""
+
+import argparse
+import asyncio
+import logging
+import socket
+from collections import defaultdict
+from typing import List, Tuple
+
+from aioredis.exceptions import RedisError
+
+from app.containers import create_container
+from app.models.pymodels import RewardEvent
+from app.utils import ModelNotFoundError
+
+logger = logging.getLogger("reward_consumer")
+
+# seconds to wait after a batch that was not fully acknowledged, doubling up to the maximum
+MIN_BACKOFF = 0.1
+MAX_BACKOFF = 10.0
+
+
+async def apply_batch(algorithms: dict, batch: List[Tuple[str, RewardEvent]]) -> List[str]:
+    """Apply a batch grouped per model and return the event ids that can be acknowledged."""
+    groups = defaultdict(list)
+    for event_id, event in batch:
+        groups[(event.algorithm, event.model_name)].append((event_id, event))
+
+    done = []
+    for (algorithm, model_name), entries in groups.items():
+        event_ids = [event_id for event_id, _ in entries]
+        if algorithm not in algorithms:
+            logger.warning("dropping %d events with unknown algorithm %s", len(entries), algorithm)
+            done.extend(event_ids)
+            continue
+        try:
+            applied = await algorithms[algorithm].apply_rewards(model_name, [event for _, event in entries])
+        except ModelNotFoundError as e:
+            logger.warning("dropping %d events for %s: %s", len(entries), model_name, e)
+        except Exception:
+            # invalid events are dropped by apply_rewards, so this is Redis or a bug: retry later
+            logger.exception("failed to apply %d events for %s, leaving them pending", len(entries), model_name)
+            continue
+        else:
+            logger.debug("applied %d/%d events for %s", applied, len(entries), model_name)
+        done.extend(event_ids)
+    return done
+
+
+async def run(consumer: str, batch_size: int, block_ms: int, claim_idle_ms: int) -> None:
+    container = create_container()
+    await container.init_resources()
+    try:
+        stream = await container.reward_stream()
+        algorithms = {
+            "egreedy": await container.egreedy(),
+            "linucb": await container.linucb(),
+        }
+        await stream.ensure_group()
+
+        # finish whatever this consumer had in flight before it last stopped, each event once:
+        # those failing again stay pending and are retried through claim_stale
+        after = "0"
+        try:
+            while True:
+                batch = await stream.read(consumer, batch_size, pending=True, after=after)
+                if not batch:
+                    break
+                await stream.ack(await apply_batch(algorithms, batch))
+                after = batch[-1][0]
+        except RedisError:
+            logger.exception("failed to re-read pending reward events, leaving them to claim_stale")
+
+        backoff = 0.0
+        while True:
+            batch, done = [], None
+            try:
+                batch = await stream.claim_stale(consumer, batch_size, claim_idle_ms)
+                batch += await stream.read(consumer, batch_size, block=block_ms)
+                applied = await apply_batch(algorithms, batch) if batch else []
+                await stream.ack(applied)
+                done = applied
+            except RedisError:
+                logger.exception("failed to read or acknowledge reward events")
+            if done is None or len(done) < len(batch):
+                backoff = min(max(backoff * 2, MIN_BACKOFF), MAX_BACKOFF)
+                await asyncio.sleep(backoff)
+            else:
+                backoff = 0.0
+    finally:
+        await container.shutdown_resources()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply bandit rewards from the reward stream")
+    parser.add_argument("--consumer", default=socket.gethostname(), help="consumer name, stable across restarts")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--block-ms", type=int, default=1000)
+    parser.add_argument("--claim-idle-ms", type=int, default=60000, help="take over events pending this long elsewhere")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(run(args.consumer, args.batch_size, args.block_ms, args.claim_idle_ms))
+
+
+if __name__ == "__main__":
+    main()
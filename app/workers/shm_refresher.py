@@ -0,0 +1,92 @@
+"""Shared memory refresher: keeps this host's copies of hot LinUCB models current.
+
+Run exactly one per host, next to API workers started with SHM_CACHE_ENABLED=1:
+
+    SHM_CACHE_MODELS=model-a,model-b python -m app.workers.shm_refresher --interval 1
+
+Each cycle reads every hot model from Redis once and publishes its inverse
+covariance matrices, arm coefficients and action tries. Workers then score
+those models without reading their state from Redis, so state reads per host
+drop from one per request to one per model per interval, and the host holds
+one copy of each model instead of one per worker. Each selection still writes
+its tries and covariance update to Redis.
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import time
+
+from app.containers import create_container
+from app.services.shared_model_cache import SharedModelWriter
+
+logger = logging.getLogger("shm_refresher")
+
+
+async def run(model_names, interval: float, workers: int) -> None:
+    container = create_container()
+    await container.init_resources()
+    writer = SharedModelWriter(container.config.shm_cache_prefix())
+    # models not shared for a ValueError, logged once until they are shared again
+    dropped = set()
+    try:
+        linucb = await container.linucb()
+        while True:
+            started = time.monotonic()
+            total_bytes = 0
+            for model_name in model_names:
+                try:
+                    model_meta, covariance_matrices, reward_matrix, action_tries = await linucb.load_state(model_name)
+                    redis_commands, redis_bytes = await linucb.uncached_read_cost(model_name)
+                    inverse_covariance_matrices, arm_coefficients = linucb.coefficients(
+                        covariance_matrices, reward_matrix
+                    )
+                except ValueError as e:
+                    # deleted, not a LinUCB model or not invertible: workers read it from Redis
+                    if model_name not in dropped:
+                        logger.warning("not sharing %s: %s", model_name, e)
+                        dropped.add(model_name)
+                    writer.drop(model_name)
+                    continue
+                except Exception:
+                    # one failing model must not stop the refresher, which would unlink every segment
+                    logger.exception("failed to load %s, keeping the previous copy", model_name)
+                    continue
+                dropped.discard(model_name)
+                total_bytes += writer.publish(
+                    model_name,
+                    {
+                        "actions": model_meta["actions"],
+                        "alpha": model_meta["alpha"],
+                        # what each cache hit saves a worker, for its /v1/cache/stats
+                        "redis_commands": redis_commands,
+                        "redis_bytes": redis_bytes,
+                    },
+                    [inverse_covariance_matrices, arm_coefficients, action_tries],
+                )
+            logger.info(
+                "refreshed %d models, %d bytes shared, %d bytes saved over %d private worker copies",
+                len(writer.segments), total_bytes, total_bytes * (workers - 1), workers,
+            )
+            await asyncio.sleep(max(0.0, interval - (time.monotonic() - started)))
+    finally:
+        writer.close()
+        await container.shutdown_resources()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Publish hot LinUCB models into host shared memory")
+    parser.add_argument("--models", default=os.environ.get("SHM_CACHE_MODELS", ""), help="comma separated model names")
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds between refreshes")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("WEB_CONCURRENCY", "1")),
+                        help="API workers on this host, for the memory savings report")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    model_names = [name.strip() for name in args.models.split(",") if name.strip()]
+    asyncio.run(run(model_names, args.interval, args.workers))
+
+
+if __name__ == "__main__":
+    main()
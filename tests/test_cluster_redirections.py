@@ -0,0 +1,201 @@
+"""ClusterNodeClient/ClusterNodePipeline against a fake two-master cluster.
+
+Each master is a RESP proxy in front of its own fakeredis server. It answers
+CLUSTER SLOTS with the current owner of every slot and, once the slot moved
+away, replies to keyed commands with MOVED (or ASK), as Redis Cluster does.
+"""
+
+import asyncio
+import threading
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+aioredis = pytest.importorskip("aioredis")
+
+from app.config.redis_router import init_redis_router  # noqa: E402
+from app.utils import transact  # noqa: E402
+
+UNKEYED = {b"MULTI", b"EXEC", b"DISCARD", b"PING", b"UNWATCH", b"CLIENT", b"HELLO", b"SELECT", b"INFO"}
+
+
+async def read_reply(reader: asyncio.StreamReader) -> bytes:
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError
+    if line[:1] == b"$" and int(line[1:-2]) >= 0:
+        return line + await reader.readexactly(int(line[1:-2]) + 2)
+    if line[:1] in b"*%~>":
+        n = int(line[1:-2]) * (2 if line[:1] == b"%" else 1)
+        for _ in range(max(n, 0)):
+            line += await read_reply(reader)
+    return line
+
+
+def encode(value) -> bytes:
+    if isinstance(value, int):
+        return b":%d\r\n" % value
+    if isinstance(value, bytes):
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+    return b"*%d\r\n" % len(value) + b"".join(encode(item) for item in value)
+
+
+class FakeCluster:
+    def __init__(self):
+        self.owner = None
+        self.redirect = "MOVED"
+        self.backends = []
+        self.ports = []
+
+    async def start(self, n: int) -> None:
+        for _ in range(n):
+            backend = fakeredis.TcpFakeServer(("127.0.0.1", 0), server_type="redis")
+            threading.Thread(target=backend.serve_forever, daemon=True).start()
+            proxy = await asyncio.start_server(
+                lambda r, w, port=backend.server_address[1]: self.serve(r, w, port), "127.0.0.1", 0
+            )
+            self.backends.append(backend)
+            self.ports.append(proxy.sockets[0].getsockname()[1])
+        self.owner = self.ports[0]
+
+    def backend(self, i: int):
+        return aioredis.Redis(port=self.backends[i].server_address[1])
+
+    def stop(self) -> None:
+        for backend in self.backends:
+            backend.shutdown()
+            backend.server_close()
+
+    async def serve(self, reader, writer, backend_port: int) -> None:
+        port = writer.get_extra_info("sockname")[1]
+        backend_reader, backend_writer = await asyncio.open_connection("127.0.0.1", backend_port)
+        asking = aborted = False
+        try:
+            while True:
+                request = await read_reply(reader)
+                parts = request.split(b"\r\n")
+                command = [parts[2 + 2 * i] for i in range(int(parts[0][1:]))]
+                name = command[0].upper()
+                if name == b"CLUSTER":
+                    writer.write(encode([[0, 16383, [b"127.0.0.1", self.owner]]]))
+                    continue
+                if name == b"ASKING":
+                    asking = True
+                    writer.write(b"+OK\r\n")
+                    continue
+                moved_away = name not in UNKEYED and self.owner != port
+                if moved_away and not (self.redirect == "ASK" and asking):
+                    aborted = True
+                    writer.write(b"-%s 0 127.0.0.1:%d\r\n" % (self.redirect.encode(), self.owner))
+                    continue
+                asking = False
+                if name == b"MULTI":
+                    aborted = False
+                if name == b"EXEC" and aborted:
+                    backend_writer.write(encode([b"DISCARD"]))
+                    await read_reply(backend_reader)
+                    writer.write(b"-EXECABORT Transaction discarded because of previous errors.\r\n")
+                    continue
+                backend_writer.write(request)
+                writer.write(await read_reply(backend_reader))
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+            backend_writer.close()
+
+
+def run_in_cluster(scenario):
+    async def run():
+        cluster = FakeCluster()
+        await cluster.start(2)
+        routers = init_redis_router("cluster", "127.0.0.1", str(cluster.ports[0]), "0")
+        router = await routers.__anext__()
+        try:
+            return await scenario(cluster, router)
+        finally:
+            await routers.aclose()
+            cluster.stop()
+
+    return asyncio.run(run())
+
+
+async def migrate(cluster: FakeCluster, key: str) -> None:
+    """Copy 'key' to the second master and make it the owner of every slot."""
+    await cluster.backend(1).set(key, await cluster.backend(0).get(key))
+    cluster.owner = cluster.ports[1]
+
+
+def test_moved_command_is_retried_on_the_new_owner_and_refreshes_the_slot_map():
+    async def scenario(cluster, router):
+        client = router.for_key("k")
+        await client.set("k", 1)
+        await migrate(cluster, "k")
+        assert await client.get("k") == b"1"
+        assert router.node_for_key("k") == f"redis://127.0.0.1:{cluster.ports[1]}/0"
+
+    run_in_cluster(scenario)
+
+
+def test_moved_transaction_is_resent():
+    async def scenario(cluster, router):
+        client = router.for_key("k")
+        await client.set("k", 1)
+        await migrate(cluster, "k")
+        async with client.pipeline(transaction=True) as pipe:
+            pipe.incr("k")
+            pipe.incr("k")
+            assert await pipe.execute() == [2, 3]
+        assert await cluster.backend(0).get("k") == b"1"
+
+    run_in_cluster(scenario)
+
+
+def test_plain_pipeline_resends_only_the_moved_commands():
+    async def scenario(cluster, router):
+        client = router.for_key("k")
+        await client.set("k", 1)
+        await migrate(cluster, "k")
+        async with client.pipeline(transaction=False) as pipe:
+            pipe.ping()
+            pipe.incr("k")
+            assert await pipe.execute() == [True, 2]
+
+    run_in_cluster(scenario)
+
+
+@pytest.mark.parametrize("moved_at", ["read", "exec"])
+def test_transact_reruns_on_the_new_owner_when_watched_keys_move(moved_at):
+    async def scenario(cluster, router):
+        client = router.for_key("k")
+        await client.set("k", 1)
+        attempts = []
+
+        async def increment(pipe):
+            attempts.append(1)
+            if len(attempts) == 1 and moved_at == "read":
+                await migrate(cluster, "k")
+            value = int(await pipe.get("k"))
+            if len(attempts) == 1 and moved_at == "exec":
+                await migrate(cluster, "k")
+            pipe.multi()
+            pipe.set("k", value + 1)
+
+        await transact(client, ["k"], increment)
+        assert len(attempts) == 2
+        assert await cluster.backend(0).get("k") == b"1"
+        assert await cluster.backend(1).get("k") == b"2"
+
+    run_in_cluster(scenario)
+
+
+def test_ask_is_followed_without_changing_the_slot_map():
+    async def scenario(cluster, router):
+        client = router.for_key("k")
+        await client.set("k", 1)
+        await migrate(cluster, "k")
+        cluster.redirect = "ASK"
+        assert await client.get("k") == b"1"
+        assert router.node_for_key("k") == f"redis://127.0.0.1:{cluster.ports[0]}/0"
+
+    run_in_cluster(scenario)
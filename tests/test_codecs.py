@@ -0,0 +1,96 @@
+from typing import List, Optional
+
+import msgpack
+import numpy as np
+import orjson
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+from pydantic import BaseModel
+
+from app.codecs import FLOAT32, JSON, MSGPACK, NegotiatedRoute, decode_body, encode_response, request_context
+from app.models.pymodels import GeneralResponse
+
+
+class EchoRequest(BaseModel):
+    model_name: str
+    context: Optional[List[float]]
+
+
+app = FastAPI()
+app.router.route_class = NegotiatedRoute
+
+
+@app.post("/echo")
+async def echo(request: EchoRequest, http_request: Request):
+    context = request_context(http_request, request.context)
+    return encode_response(
+        http_request,
+        GeneralResponse(
+            message="OK",
+            status_code=200,
+            data={"model_name": request.model_name, "context": None if context is None else context.tolist()},
+        ),
+    )
+
+
+client = TestClient(app)
+
+
+def test_decode_body_takes_the_context_out_of_json():
+    fields, context = decode_body(JSON, orjson.dumps({"model_name": "m", "context": [1, 2.5]}), {})
+    assert fields == {"model_name": "m"}
+    assert context.dtype == np.float64
+    assert context.tolist() == [1.0, 2.5]
+
+
+def test_decode_body_leaves_contexts_numpy_cannot_read():
+    for context in ([[1], [2]], ["x", 1], None):
+        fields, array = decode_body(JSON, orjson.dumps({"model_name": "m", "context": context}), {})
+        assert array is None
+        assert fields["context"] == context
+
+
+def test_decode_body_binary_contexts():
+    context = np.array([0.5, 1.5], dtype="<f4")
+    fields, array = decode_body(MSGPACK, msgpack.packb({"model_name": "m", "context": context.tobytes()}), {})
+    assert fields == {"model_name": "m"}
+    assert array.tolist() == [0.5, 1.5]
+
+    fields, array = decode_body(FLOAT32, context.tobytes(), {"model_name": "m"})
+    assert fields == {"model_name": "m"}
+    assert array.tolist() == [0.5, 1.5]
+
+
+def test_json_request():
+    response = client.post("/echo", json={"model_name": "m", "context": [1, 2]})
+    assert response.status_code == 200
+    assert response.json()["data"] == {"model_name": "m", "context": [1.0, 2.0]}
+
+
+def test_msgpack_request_and_response():
+    context = np.array([0.5, 1.5], dtype="<f4")
+    response = client.post(
+        "/echo",
+        content=msgpack.packb({"model_name": "m", "context": context.tobytes()}),
+        headers={"content-type": MSGPACK, "accept": MSGPACK},
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"] == MSGPACK
+    assert msgpack.unpackb(response.content)["data"] == {"model_name": "m", "context": [0.5, 1.5]}
+
+
+def test_float32_request():
+    context = np.array([0.5, 1.5], dtype="<f4")
+    response = client.post("/echo?model_name=m", content=context.tobytes(), headers={"content-type": FLOAT32})
+    assert response.status_code == 200
+    assert response.json()["data"] == {"model_name": "m", "context": [0.5, 1.5]}
+
+
+def test_truncated_float32_request_is_rejected():
+    response = client.post("/echo?model_name=m", content=b"\x00" * 6, headers={"content-type": FLOAT32})
+    assert response.status_code == 400
+
+
+def test_nested_list_context_is_a_validation_error():
+    response = client.post("/echo", json={"model_name": "m", "context": [[1], [2]]})
+    assert response.status_code == 422
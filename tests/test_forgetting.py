@@ -0,0 +1,68 @@
+import asyncio
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from app.algorithms.forgetting import (
+    REBASE_HALF_LIVES,
+    ExponentialDecay,
+    forgetting_from_meta,
+    forgetting_meta,
+)
+
+
+def test_decay_halves_after_one_half_life():
+    decay = forgetting_from_meta({"forgetting": forgetting_meta(decay_half_life=60)})
+    stored = decay.add(decay.initial((2,), 1000.0), 0, 4.0, 1000.0)
+
+    np.testing.assert_allclose(decay.view(stored, 1000.0), [4.0, 0.0])
+    np.testing.assert_allclose(decay.view(stored, 1060.0), [2.0, 0.0])
+    np.testing.assert_allclose(decay.view(stored, 1120.0), [1.0, 0.0])
+
+
+def test_decay_rebase_keeps_reads_unchanged():
+    decay = ExponentialDecay(half_life=1.0)
+    stored = decay.add(decay.initial((2,), 0.0), [0, 1], [3.0, 5.0], 0.0)
+    now = REBASE_HALF_LIVES + 1.0
+
+    rebased = decay.add(stored, 0, 0.0, now)
+
+    assert rebased["landmark"] == now
+    for t in (now, now + 0.5, now + 3.0):
+        np.testing.assert_allclose(decay.view(rebased, t), decay.view(stored, t))
+
+
+def test_window_empties_after_window_seconds():
+    window = forgetting_from_meta({"forgetting": forgetting_meta(window_seconds=30, window_buckets=3)})
+    stored = window.add(window.initial((2,), 100.0), 1, 1.0, 100.0)
+    stored = window.add(stored, 1, 1.0, 115.0)
+
+    np.testing.assert_allclose(window.view(stored, 115.0), [0.0, 2.0])
+    # the bucket of t=100 leaves the window first
+    np.testing.assert_allclose(window.view(stored, 130.0), [0.0, 1.0])
+    np.testing.assert_allclose(window.view(stored, 150.0), [0.0, 0.0])
+
+
+def test_window_arm_is_untested_again_once_its_window_empties(monkeypatch):
+    fakeredis = pytest.importorskip("fakeredis")
+    from app.algorithms import egreedy
+    from app.config.redis_router import RedisRouter
+
+    clock = SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(egreedy, "time", SimpleNamespace(time=lambda: clock.now))
+    bandit = egreedy.EGreedy(RedisRouter.standalone(fakeredis.FakeAsyncRedis()))
+
+    async def run():
+        await bandit.create_model(
+            "drift", ["a", "b"], epsilon=0.0, forgetting=forgetting_meta(window_seconds=30, window_buckets=3)
+        )
+        assert await bandit.select_action_and_best("drift") == ("a", None)
+        assert await bandit.select_action_and_best("drift") == ("b", None)
+        _, best = await bandit.select_action_and_best("drift")
+        assert best is not None
+
+        clock.now += 30
+        assert await bandit.select_action_and_best("drift") == ("a", None)
+
+    asyncio.run(run())
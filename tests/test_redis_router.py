@@ -0,0 +1,55 @@
+from aioredis.exceptions import ConnectionError, ResponseError
+
+from app import keys
+from app.config.redis_router import HashRing, RedisRouter, key_slot, redirection
+
+
+def test_redirection_of_a_command_error():
+    assert redirection(ResponseError("MOVED 3999 127.0.0.1:6381")) == ("MOVED", "redis://127.0.0.1:6381/0")
+    assert redirection(ResponseError("ASK 3999 10.0.0.2:7000")) == ("ASK", "redis://10.0.0.2:7000/0")
+
+
+def test_redirection_of_an_error_annotated_by_a_transaction():
+    error = ResponseError("Command # 1 (INCRBY {m}:k 1) of pipeline caused error: ('MOVED 3999 10.0.0.2:7000',)")
+    assert redirection(error) == ("MOVED", "redis://10.0.0.2:7000/0")
+
+
+def test_redirection_ignores_other_errors():
+    assert redirection(ResponseError("WRONGTYPE Operation against a key holding the wrong kind of value")) is None
+    assert redirection(ResponseError("ERR unknown command 'MOVED 1 a:1'")) is None
+    assert redirection(ConnectionError("MOVED 3999 127.0.0.1:6381")) is None
+
+
+def test_key_slot_matches_redis():
+    # values from CLUSTER KEYSLOT
+    assert key_slot("foo") == 12182
+    assert key_slot("bar") == 5061
+    assert key_slot("hello") == 866
+    assert key_slot("somekey") == 11058
+    assert key_slot("123456789") == 12739
+
+
+def test_key_slot_hashes_the_hash_tag():
+    assert key_slot("{user1000}.following") == key_slot("{user1000}.followers") == 3443
+    assert key_slot("foo{bar}{zap}") == key_slot("bar")
+    assert key_slot("foo{{bar}}zap") == 4015
+    # an empty tag does not count, the whole key is hashed
+    assert key_slot("foo{}{bar}") == 8363
+    assert len({key_slot(key) for key in keys.model_keys("model-a")}) == 1
+
+
+def test_hash_ring_moves_about_one_nth_of_the_models_to_the_new_node():
+    model_names = [f"model-{i}" for i in range(5000)]
+    for n in (1, 2, 3, 7):
+        before = HashRing([f"node-{i}" for i in range(n)])
+        after = HashRing([f"node-{i}" for i in range(n + 1)])
+        moved = [name for name in model_names if before.get_node(name) != after.get_node(name)]
+        assert {after.get_node(name) for name in moved} == {f"node-{n}"}
+        assert abs(len(moved) / len(model_names) - 1 / (n + 1)) < 0.05
+
+
+def test_sharded_mode_keeps_global_keys_on_the_first_node():
+    for n in range(1, 6):
+        router = RedisRouter("sharded", {f"node-{i}": None for i in range(n)})
+        for key in (keys.MODEL_REGISTRY, keys.MODEL_USAGE, "reward_events", "reward_events:dead"):
+            assert router.node_for_key(key) == "node-0"
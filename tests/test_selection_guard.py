@@ -0,0 +1,119 @@
+import asyncio
+
+import pytest
+
+from app.services.selection_guard import Decision, SelectionGuard
+
+
+def test_admit_sheds_once_the_inflight_slots_are_taken():
+    guard = SelectionGuard(max_inflight=2)
+    assert guard.admit() and guard.admit()
+    assert not guard.admit()
+    guard.release()
+    assert guard.admit()
+    assert guard.stats()["shed"] == 1
+    assert guard.stats()["requests"] == 3
+
+
+def test_budget_is_the_tighter_positive_one():
+    assert SelectionGuard().budget() is None
+    assert SelectionGuard().budget(250) == 0.25
+    assert SelectionGuard(budget_ms=100).budget(250) == 0.1
+    assert SelectionGuard(budget_ms=100).budget(50) == 0.05
+    assert SelectionGuard(budget_ms=100).budget(0) == 0.1
+    assert SelectionGuard(budget_ms=100).budget(-5) == 0.1
+    assert SelectionGuard().budget(-5) is None
+
+
+def test_fallback_is_the_last_known_best_action():
+    guard = SelectionGuard()
+    guard.remember("m", "c", actions=["a", "b", "c"], best_action="b")
+    guard.remember("m", "a")
+    assert guard.fallback("m") == "b"
+    assert guard.models["m"] == (["a", "b", "c"], "b")
+
+
+def test_fallback_is_random_without_a_best_action():
+    guard = SelectionGuard()
+    guard.remember("m", actions=["a", "b"])
+    assert guard.fallback("m") in ("a", "b")
+    assert SelectionGuard(fallback="random").fallback("unknown") is None
+
+
+def test_timeouts_count_fallbacks_and_unknown_models():
+    guard = SelectionGuard()
+    guard.remember("m", actions=["a", "b"], best_action="a")
+    for _ in range(4):
+        guard.admit()
+    assert guard.fallback("m") == "a"
+    assert guard.fallback("unknown") is None
+    stats = guard.stats()
+    assert (stats["timeouts"], stats["fallbacks"]) == (2, 1)
+    assert (stats["timeout_rate"], stats["fallback_rate"]) == (0.5, 0.25)
+
+
+def test_usage_and_least_recently_used_models():
+    guard = SelectionGuard(max_models=2)
+    guard.remember("a", "x", actions=["x"])
+    guard.remember("b", "x", actions=["x"])
+    guard.remember("a", "x")
+    guard.remember("c", "x", actions=["x"])
+    assert list(guard.models) == ["a", "c"]
+    assert guard.take_usage() == {"a": 2, "b": 1, "c": 1}
+    assert guard.take_usage() == {}
+    assert guard.stats()["selections"] == 4
+
+
+def test_decision_keeps_the_selected_action():
+    decision = Decision()
+    assert decision.select("a") == "a"
+    decision.fall_back("b")
+    assert decision.action == "b"
+
+
+def test_decision_records_the_fallback_once_it_was_served():
+    decision = Decision()
+    decision.fall_back("b")
+    assert decision.select("a") == "b"
+
+
+def test_decision_records_nothing_for_an_abandoned_request():
+    decision = Decision()
+    decision.fall_back(None)
+    assert decision.select("a") is None
+
+
+def test_fallback_arm_is_the_one_counted(monkeypatch):
+    fakeredis = pytest.importorskip("fakeredis")
+    import msgpack_numpy as m
+
+    from app import keys
+    from app.algorithms.egreedy import EGreedy
+    from app.algorithms.linucb import LinUCB
+    from app.config.redis_router import RedisRouter
+    from app.services.bandit_service import BanditService
+    from app.services.selection_guard import SelectionGuard
+
+    redis = fakeredis.FakeAsyncRedis()
+    router = RedisRouter.standalone(redis)
+    guard = SelectionGuard(budget_ms=20)
+    service = BanditService(router, EGreedy(router), LinUCB(router), None, guard, None)
+
+    async def slow_selection(model_name):
+        await asyncio.sleep(0.1)
+        return "a", "a"
+
+    async def run():
+        await service.egreedy.create_model("drift", ["a", "b"], epsilon=0.0)
+        for _ in range(2):
+            await service.select_action("egreedy", "drift")
+        await service.egreedy.reward_action("drift", "b")
+        await service.select_action("egreedy", "drift")
+
+        monkeypatch.setattr(service.egreedy, "_epsilon_greedy_selection", slow_selection)
+        assert guard.admit()
+        assert await service.select_action_within("egreedy", "drift") == ("b", True)
+        await asyncio.sleep(0.2)
+        return m.unpackb(await redis.get(keys.action_tries("drift")))
+
+    assert asyncio.run(run()).tolist() == [1, 3]